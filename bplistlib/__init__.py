@@ -12,8 +12,8 @@ To write a plist use one of:
     writePlist(root_object, path_or_file)
     writePlistToString(root_object)
 
-Called like this, these functions will write an xml plist using
-plistlib. To write a binary plist, use one of:
+Called like this, these functions will write an xml plist. To write a
+binary plist, use one of:
 
     writePlist(root_object, path_or_file, binary=True)
     writePlistToString(root_object, binary=True)
@@ -44,7 +44,6 @@ not enforced. There may be other unenforced restrictions, be reasonable.
 
 # TODO: update docstrings
 # TODO: reorganize for fewer files
-# TODO: autodetect byte length for strings by characters used, not python type
 # TODO: set type, id is 0xc
 # TODO: only data, string, array, set, and dict support extended int count
 # TODO: date is always 8 byte float, len=3
@@ -53,14 +52,23 @@ not enforced. There may be other unenforced restrictions, be reasonable.
 
 from .public import readPlist, readPlistFromString
 from .public import writePlist, writePlistToString
-from .public import dump, dumps, load, loads
-from .types import UID, Fill
+from .public import dump, dumps, load, loads, convert, estimate
+from .index import build_index, query
+from .cache import PlistCache
+from .validate import validate, InvalidPlistError
+from .diff import diff
+from .merge import merge
+from .classes import LimitExceededError
+from .types import UID, Fill, UTC
 
 
 __all__ = ['readPlist', 'readPlistFromString',
            'writePlist', 'writePlistToString',
-           'UID', 'Fill',
-           'dump', 'dumps', 'load', 'loads']
+           'UID', 'Fill', 'UTC',
+           'dump', 'dumps', 'load', 'loads', 'convert', 'estimate',
+           'build_index', 'query', 'PlistCache',
+           'validate', 'InvalidPlistError', 'LimitExceededError',
+           'diff', 'merge']
 
 __packages__ = ['bplistlib']
 __version__ = '0.2pre'
@@ -0,0 +1,255 @@
+# encoding: utf-8
+"""
+This file contains the command line interface of the bplistlib module.
+
+    python -m bplistlib info path
+    python -m bplistlib stats path
+    python -m bplistlib get path [key ...]
+    python -m bplistlib convert input output [--binary | --xml]
+                                             [--compression name]
+
+info reads only the trailer and the offset table of a binary plist, and
+stats only the first bytes of each object as well, so both take about the
+same time for any size of file. get decodes only the object asked for,
+using the key path index if there is one, and convert streams conversions
+between formats.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from struct import error as StructError
+import sys
+from xml.parsers.expat import ExpatError
+from .classes import ObjectHandler
+from .compression import detect_compression, open_compressed
+from .index import open_index
+from .public import dump, load, convert
+from .readwrite import ObjectReader, read_trailer, read_table
+from .validate import TYPE_NAMES
+from .validate import call_with_buffer, check_trailer, read_offsets
+from .validate import read_header
+
+
+def info(path, output):
+    """Write the format, trailer and offset table details of a plist."""
+    with open(path, 'rb') as file_object:
+        compression = detect_compression(file_object)
+        file_object = open_compressed(file_object)
+        file_object.seek(0, 2)
+        size = file_object.tell()
+        file_object.seek(0)
+        binary = file_object.read(8) == 'bplist00'
+        details = [('format', 'binary' if binary else 'xml'),
+                   ('compression', compression or 'none'), ('size', size)]
+        if binary:
+            trailer = read_trailer(file_object)
+            offset_size, reference_size, length, root, table_offset = trailer
+            offsets = read_table(file_object, offset_size, length,
+                                 table_offset)
+            ascending = all(offsets[i] < offsets[i + 1]
+                            for i in range(len(offsets) - 1))
+            details += [('objects', length), ('root', root),
+                        ('offset_size', offset_size),
+                        ('reference_size', reference_size),
+                        ('table_offset', table_offset),
+                        ('object_bytes', table_offset - 8),
+                        ('offsets_ascending', ascending)]
+    for name, value in details:
+        output.write('%s: %s\n' % (name, value))
+
+
+def count_types(buffer_):
+    """
+    Return a dictionary mapping the name of each type of object in the
+    binary plist in a string or memory map to the number of objects of that
+    type and their size in bytes, read from the object headers alone.
+    """
+    offset_size, reference_size, length, root, table_offset = check_trailer(
+        buffer_)
+    object_handler = ObjectHandler()
+    object_handler.set_reference_size(reference_size)
+    types = {}
+    for offset in read_offsets(buffer_, offset_size, length, table_offset):
+        object_type, body_offset, byte_length = read_header(
+            buffer_, offset, table_offset, object_handler)
+        count, size = types.get(TYPE_NAMES[object_type], (0, 0))
+        size += body_offset - offset + byte_length
+        types[TYPE_NAMES[object_type]] = (count + 1, size)
+    return types
+
+
+def stats(path, output):
+    """Write a histogram of the types of objects in a binary plist."""
+    with open(path, 'rb') as file_object:
+        types = call_with_buffer(count_types, file_object)
+    output.write('%-8s %12s %14s\n' % ('type', 'objects', 'bytes'))
+    total_count = total_size = 0
+    for name, (count, size) in sorted(types.items(),
+                                      key=lambda item: -item[1][1]):
+        output.write('%-8s %12i %14i\n' % (name, count, size))
+        total_count += count
+        total_size += size
+    output.write('%-8s %12i %14i\n' % ('total', total_count, total_size))
+
+
+class KeyPathError(LookupError):
+    """Raised by get when there is no object at a key path."""
+
+
+def get(path, keys):
+    """
+    Return the object found by following keys, a sequence of strings, from
+    the root of the plist at path. Keys are taken to be array indices where
+    the container they are looked up in is an array. Raise KeyPathError if
+    there is no such object.
+    """
+    with open(path, 'rb') as file_object:
+        file_object = open_compressed(file_object)
+        if file_object.read(8) != 'bplist00':
+            file_object.seek(0)
+            return get_item(load(file_object, binary=False), keys)
+        reader = ObjectReader(file_object, lazy=True, dates='utc')
+        reference, offset = find_reference(path, file_object, reader, keys)
+        return reader.read_object(reference, offset)
+
+
+def find_reference(path, file_object, reader, keys):
+    """
+    Return the reference number and the offset, or None if it isn't known,
+    of the object at keys in the binary plist in file_object read by
+    reader. It is looked up in the key path index if there is one, or
+    followed from the root otherwise.
+    """
+    index = open_index(path, plist=file_object)
+    if index is not None:
+        key_path = [int(key) if key.isdigit() else key for key in keys]
+        try:
+            return index.lookup(key_path)
+        except KeyError:
+            pass
+        finally:
+            index.close()
+    reference = reader.root
+    for key in keys:
+        container = reader.read_flat(reference)
+        if type(container) == list:
+            index = to_index(key)
+            if index >= len(container):
+                raise KeyPathError(key)
+            reference = container[index]
+        elif type(container) == dict:
+            for key_reference, value_reference in container.items():
+                if reader.read_flat(key_reference) == key:
+                    reference = value_reference
+                    break
+            else:
+                raise KeyPathError(key)
+        else:
+            raise KeyPathError(key)
+    return reference, None
+
+
+def get_item(object_, keys):
+    """Return the item at keys in a decoded plist, as get does."""
+    for key in keys:
+        if type(object_) == list:
+            index = to_index(key)
+            if index >= len(object_):
+                raise KeyPathError(key)
+            object_ = object_[index]
+        elif type(object_) == dict and key in object_:
+            object_ = object_[key]
+        else:
+            raise KeyPathError(key)
+    return object_
+
+
+def to_index(key):
+    """Return key as an array index, or raise KeyPathError."""
+    if not key.isdigit():
+        raise KeyPathError(key)
+    return int(key)
+
+
+def write_object(object_, output):
+    """
+    Write a decoded object, as an XML plist if it is an array or a
+    dictionary, or as a line of text otherwise.
+    """
+    if type(object_) in (list, dict):
+        dump(object_, output)
+    elif isinstance(object_, unicode):
+        output.write(object_.encode('utf_8') + '\n')
+    elif isinstance(object_, str):
+        output.write(object_ + '\n')
+    elif isinstance(object_, datetime):
+        output.write(object_.isoformat() + '\n')
+    else:
+        output.write(repr(object_) + '\n')
+
+
+def convert_file(input_path, output_path, binary=None, compression=None):
+    """Convert the plist at input_path, writing it to output_path."""
+    with open(input_path, 'rb') as input_file:
+        with open(output_path, 'wb') as output_file:
+            convert(input_file, output_file, binary, compression)
+
+
+def get_parser():
+    """Return the parser for the command line arguments."""
+    parser = ArgumentParser(prog='python -m bplistlib',
+                            description='Inspect and convert plists.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparser = subparsers.add_parser(
+        'info', help='show the trailer and offset table of a plist')
+    subparser.add_argument('path')
+    subparser = subparsers.add_parser(
+        'stats', help='count the objects of each type in a binary plist')
+    subparser.add_argument('path')
+    subparser = subparsers.add_parser(
+        'get', help='print the object at a key path')
+    subparser.add_argument('path')
+    subparser.add_argument('keys', nargs='*', metavar='key',
+                           help='a dictionary key or array index')
+    subparser = subparsers.add_parser(
+        'convert', help='convert a plist between formats')
+    subparser.add_argument('input')
+    subparser.add_argument('output')
+    format_group = subparser.add_mutually_exclusive_group()
+    format_group.add_argument('--binary', dest='binary', action='store_true',
+                              default=None, help='write a binary plist')
+    format_group.add_argument('--xml', dest='binary', action='store_false',
+                              help='write an XML plist')
+    subparser.add_argument('--compression',
+                           choices=('gzip', 'bz2', 'lzma', 'block'))
+    return parser
+
+
+def main(arguments, output=sys.stdout):
+    """Run the command given by arguments, and return the exit status."""
+    arguments = get_parser().parse_args(arguments)
+    try:
+        if arguments.command == 'info':
+            info(arguments.path, output)
+        elif arguments.command == 'stats':
+            stats(arguments.path, output)
+        elif arguments.command == 'get':
+            write_object(get(arguments.path, arguments.keys), output)
+        elif arguments.command == 'convert':
+            convert_file(arguments.input, arguments.output, arguments.binary,
+                         arguments.compression)
+    except KeyPathError as error:
+        sys.stderr.write('no such key: %s\n' % error.args[0])
+        return 1
+    except EnvironmentError as error:
+        sys.stderr.write('%s\n' % error)
+        return 1
+    except (ExpatError, StructError, LookupError, ValueError) as error:
+        # corrupt plists surface as any of these while decoding
+        sys.stderr.write('invalid plist: %s\n' % error)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
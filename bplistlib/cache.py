@@ -0,0 +1,198 @@
+# encoding: utf-8
+"""This file contains the parse cache for the bplistlib module."""
+
+from collections import OrderedDict
+from copy import deepcopy
+from os import stat
+from os.path import realpath
+from plistlib import Data
+from sys import getsizeof
+from threading import Lock
+
+
+class FrozenDict(dict):
+    """A dictionary which can't be changed."""
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('frozen dictionaries can not be changed')
+
+    __setitem__ = __delitem__ = __readonly
+    clear = pop = popitem = setdefault = update = __readonly
+
+    def __repr__(self):
+        return 'FrozenDict(%s)' % dict.__repr__(self)
+
+
+class FrozenList(list):
+    """An array which can't be changed."""
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('frozen arrays can not be changed')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __readonly
+    __iadd__ = __imul__ = __readonly
+    append = extend = insert = pop = remove = reverse = sort = __readonly
+
+    def __repr__(self):
+        return 'FrozenList(%s)' % list.__repr__(self)
+
+
+class FrozenData(Data):
+    """Binary data which can't be changed."""
+
+    def __init__(self, data):
+        self.__dict__['data'] = data
+
+    def __setattr__(self, name, value):
+        raise TypeError('frozen data can not be changed')
+
+    def __delattr__(self, name):
+        raise TypeError('frozen data can not be changed')
+
+    def __cmp__(self, other):
+        if isinstance(other, Data):
+            return cmp(self.data, other.data)
+        return Data.__cmp__(self, other)
+
+    def __repr__(self):
+        return 'Data(%r)' % self.data
+
+
+def get_decoded_size(root_object):
+    """
+    Return an estimate of the memory held by a decoded plist in bytes, the
+    sum of the sizes of its objects, with objects that appear more than
+    once counted once.
+    """
+    size = 0
+    seen = set()
+    stack = [root_object]
+    while stack:
+        object_ = stack.pop()
+        if id(object_) in seen:
+            continue
+        seen.add(id(object_))
+        size += getsizeof(object_)
+        if isinstance(object_, dict):
+            stack.extend(object_.iterkeys())
+            stack.extend(object_.itervalues())
+        elif isinstance(object_, list):
+            stack.extend(object_)
+        elif isinstance(object_, Data):
+            stack.append(object_.data)
+        elif isinstance(object_, memoryview):
+            size += len(object_)
+    return size
+
+
+def freeze(object_):
+    """
+    Return a copy of object_ with every container, and every plistlib.Data
+    object, frozen. Writable memoryview objects are copied to read only
+    ones.
+    """
+    if isinstance(object_, dict):
+        return FrozenDict((freeze(key), freeze(value))
+                          for key, value in object_.iteritems())
+    if isinstance(object_, list):
+        return FrozenList(freeze(item) for item in object_)
+    if isinstance(object_, Data):
+        return FrozenData(object_.data)
+    if isinstance(object_, memoryview) and not object_.readonly:
+        return memoryview(object_.tobytes())
+    return object_
+
+
+class PlistCache(object):
+    """
+    A least recently used cache of parsed plists, bounded by the total size
+    in bytes of the decoded plists, as estimated by get_decoded_size.
+    Entries are keyed by the identity of the file, its real path, inode,
+    size and modification time, so a changed file is parsed again and costs
+    nothing but a stat otherwise.
+
+    If frozen is True, cached plists are stored frozen, with dictionaries
+    as FrozenDict and arrays as FrozenList objects, and the same object is
+    returned on every hit. Otherwise each caller gets its own deep copy.
+    """
+
+    def __init__(self, max_bytes=0x4000000, frozen=False):
+        self.max_bytes = max_bytes
+        self.frozen = frozen
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, path, load, options=()):
+        """
+        Return the cached plist at path, calling load(path) to parse it if
+        it isn't cached. options identifies the decoding options used by
+        load, which are part of the cache key.
+        """
+        path = realpath(path)
+        status = stat(path)
+        key = (path, status.st_ino, status.st_size, status.st_mtime, options)
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                self.hits += 1
+                return self.prepare(entry[0])
+            self.misses += 1
+        root_object = load(path)
+        if self.frozen:
+            root_object = freeze(root_object)
+        # a compressed file can be far smaller than what it decodes to
+        size = get_decoded_size(root_object)
+        with self.lock:
+            self.discard(path, key[1:4])
+            if size <= self.max_bytes:
+                self.entries[key] = (root_object, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self.remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return self.prepare(root_object)
+
+    def prepare(self, root_object):
+        """Return root_object as it should be handed out."""
+        if self.frozen:
+            return root_object
+        return deepcopy(root_object)
+
+    def remove(self, key):
+        """Remove the entry with the given key."""
+        self.size -= self.entries.pop(key)[1]
+
+    def discard(self, path, identity=None):
+        """
+        Remove the entries for the file at path, or only those for versions
+        of it other than identity, an (inode, size, modification time)
+        tuple.
+        """
+        for key in [key for key in self.entries if key[0] == path and
+                    (identity is None or key[1:4] != identity)]:
+            self.remove(key)
+
+    def invalidate(self, path=None):
+        """Remove the entries for the file at path, or every entry."""
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                self.discard(realpath(path))
+
+    def stats(self):
+        """
+        Return a dictionary with the hits, misses and evictions so far, and
+        the current number of entries and their size in bytes.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries), 'size': self.size,
+                    'max_bytes': self.max_bytes}
@@ -5,12 +5,20 @@ a binary plist file.
 """
 
 from struct import pack, unpack
-from datetime import datetime
+from datetime import datetime, timedelta
 from plistlib import Data
-from time import mktime
-from .functions import find_with_type, get_byte_width
+from time import mktime, time
+from .functions import find_with_type, get_byte_width, get_reference_size
+from .functions import is_ascii
 from .functions import flatten_object_list, unflatten_reference_list
-from .types import UID, Fill, FillType
+from .types import UID, Fill, FillType, UTC
+
+
+# the type of plistlib.Data objects, which are old style class instances
+DATA_TYPE = type(Data(''))
+# strings up to this length are cached once encoded, up to this many
+STRING_CACHE_LENGTH = 64
+STRING_CACHE_SIZE = 4096
 
 
 class BooleanHandler(object):
@@ -93,26 +101,26 @@ class FloatHandler(IntegerHandler):
             return 3
         raise ValueError
     
-    def encode_body(self, float_, object_length):
-        body = IntegerHandler.encode_body(self, float_, object_length)
-        return body[::-1]
-    
-    def decode_body(self, raw, object_length):
-        return IntegerHandler.decode_body(self, raw, object_length)
-    
 
 class DateHandler(FloatHandler):
     """
     Handler class for dates. Subclass of the float handler because dates are
-    stored internally as the floating point number of seconds since the epoch.
+    stored internally as the floating point number of seconds since 1 Jan
+    2001. Dates are decoded according to dates: 'datetime' for naive local
+    datetime objects, 'utc' for timezone aware UTC datetime objects, or
+    'seconds' for the raw number of seconds.
     """
     
-    def __init__(self):
+    def __init__(self, dates='datetime'):
         FloatHandler.__init__(self)
         self.type_number = 3
         # seconds between 1 Jan 1970 and 1 Jan 2001
         self.epoch_adjustment = 978307200.0
+        self.epoch = datetime(2001, 1, 1, tzinfo=UTC)
         self.types = datetime
+        if dates not in ('datetime', 'utc', 'seconds'):
+            raise ValueError('unknown date format: %r' % dates)
+        self.dates = dates
     
     def get_object_length(self, date):
         return 3
@@ -123,11 +131,20 @@ class DateHandler(FloatHandler):
     
     def decode_body(self, raw, object_length):
         seconds = FloatHandler.decode_body(self, raw, object_length)
+        if self.dates == 'seconds':
+            return seconds
+        if self.dates == 'utc':
+            return self.epoch + timedelta(seconds=seconds)
         return self.convert_to_date(seconds)
     
     def convert_to_seconds(self, date):
-        """Convert a datetime object to seconds since 1 Jan 2001."""
-        seconds = mktime(date.timetuple())
+        """
+        Convert a datetime object to seconds since 1 Jan 2001. Naive
+        datetime objects are taken to be in local time.
+        """
+        if date.utcoffset() is not None:
+            return (date - self.epoch).total_seconds()
+        seconds = mktime(date.timetuple()) + date.microsecond / 1000000.0
         return seconds - self.epoch_adjustment
     
     def convert_to_date(self, seconds):
@@ -137,37 +154,64 @@ class DateHandler(FloatHandler):
     
 
 class DataHander(object):
-    """Handler class for arbitrary binary data. Uses plistlib.Data."""
+    """
+    Handler class for arbitrary binary data. Uses plistlib.Data, but also
+    encodes bytearray, memoryview and buffer objects. Data is decoded
+    according to data: 'Data' for plistlib.Data objects, 'bytes' for
+    strings, or 'memoryview' for memoryview objects.
+    """
     
-    def __init__(self):
+    def __init__(self, data='Data'):
         self.type_number = 4
         # this is ugly but maintains interop with plistlib.
-        self.types = type(Data(''))
+        self.types = (DATA_TYPE, bytearray, memoryview, buffer)
+        if data not in ('Data', 'bytes', 'memoryview'):
+            raise ValueError('unknown data format: %r' % data)
+        self.data = data
     
     def get_object_length(self, data):
-        """Get the length of the data stored inside the Data object."""
-        return len(data.data)
+        """Get the length of the binary data."""
+        if isinstance(data, Data):
+            return len(data.data)
+        if isinstance(data, memoryview):
+            return len(data) * data.itemsize
+        return len(data)
     
     def get_byte_length(self, object_length):
         """Return the object length."""
         return object_length
     
     def encode_body(self, data, object_length):
-        """Get the binary data from the Data object."""
-        return data.data
+        """Get the binary data as a string."""
+        if isinstance(data, Data):
+            return data.data
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return str(data)
     
     def decode_body(self, raw, object_length):
-        """Store the binary data in a Data object."""
+        """Return the binary data in the configured form."""
+        if self.data == 'bytes':
+            return raw
+        if self.data == 'memoryview':
+            return memoryview(raw)
         return Data(raw)
     
 
 class StringHandler(object):
-    """Handler class for strings."""
+    """
+    Handler class for ASCII strings. Both str and unicode objects are
+    encoded by this handler if they only hold ASCII characters. Decoded
+    strings are str objects, or unicode objects if strings is 'unicode'.
+    """
     
-    def __init__(self):
+    def __init__(self, strings='str'):
         self.type_number = 5
         self.encoding = 'ascii'
         self.types = str
+        if strings not in ('str', 'unicode'):
+            raise ValueError('unknown string format: %r' % strings)
+        self.strings = strings
     
     def get_object_length(self, string):
         """Return the length of the string."""
@@ -179,15 +223,22 @@ class StringHandler(object):
     
     def encode_body(self, string, object_length):
         """Return the encoded version of string, according to self.encoding."""
+        if type(string) == str:
+            return string
         return string.encode(self.encoding)
     
-    def decode_body(self, string, object_length):
-        """Return string."""
-        return string
+    def decode_body(self, raw, object_length):
+        """Return raw, decoded to unicode if configured."""
+        if self.strings == 'unicode':
+            return raw.decode(self.encoding)
+        return raw
     
 
 class UnicodeStringHandler(StringHandler):
-    """Handler class for unicode strings. Subclass of the string handler."""
+    """
+    Handler class for strings with non ASCII characters. Subclass of the
+    string handler. str objects are taken to be UTF-8 encoded.
+    """
     
     def __init__(self):
         StringHandler.__init__(self)
@@ -195,10 +246,20 @@ class UnicodeStringHandler(StringHandler):
         self.encoding = 'utf_16_be'
         self.types = unicode
     
+    def get_object_length(self, string):
+        """Return the length of the string in UTF-16 code units."""
+        return len(self.encode_body(string, None)) // 2
+    
     def get_byte_length(self, object_length):
         """Return twice the object length."""
         return object_length * 2
     
+    def encode_body(self, string, object_length):
+        """Return the encoded version of string, according to self.encoding."""
+        if type(string) == str:
+            string = string.decode('utf_8')
+        return string.encode(self.encoding)
+    
     def decode_body(self, raw, object_length):
         """Decode the raw string according to self.encoding."""
         return raw.decode(self.encoding)
@@ -218,12 +279,8 @@ class UIDHandler(IntegerHandler):
         bit_lengths = [8 * 2 ** x for x in range(4)]
         limits = [2 ** bit_length for bit_length in bit_lengths]
         for index, limit in enumerate(limits):
-            if index == 0:
-                if 0 <= uid <= limit:
-                    return index
-            else:
-                if limits[index - 1] < uid <= limit:
-                    return index
+            if 0 <= uid < limit:
+                return index
         raise ValueError
     
     def encode_body(self, uid, object_length):
@@ -242,9 +299,9 @@ class ArrayHandler(object):
     
     def __init__(self, object_handler):
         self.type_number = 0xa
-        self.types = list
+        self.types = (list, tuple)
         self.object_handler = object_handler
-        self.formats = (None, 'B', 'H')
+        self.formats = (None, 'B', 'H', None, 'L', None, None, None, 'Q')
         self.endian = '>'
         self.format = None
         self.reference_size = None
@@ -276,6 +333,7 @@ class ArrayHandler(object):
     
     def flatten(self, array, objects):
         """Flatten the array into a list of references."""
+        array = [self.object_handler.convert(item) for item in array]
         return flatten_object_list(array, objects)
     
     def unflatten(self, array, objects):
@@ -337,14 +395,36 @@ class DictionaryHandler(ArrayHandler):
 class ObjectHandler(object):
     """A master handler class for all of the object handler classes."""
     
-    def __init__(self):
-        """Intialize one of every (useful) handler class."""
+    def __init__(self, dates='datetime', data='Data', strings='str',
+                 limit_handler=None, default=None, object_hook=None,
+                 array_hook=None):
+        """
+        Intialize one of every (useful) handler class. The dates, data and
+        strings arguments select the decoded forms of dates, binary data and
+        ASCII strings. If a LimitHandler is given, decoding is checked
+        against its limits.
+        
+        default is called with any object of a type that can't be encoded,
+        and returns an object to encode in its place. object_hook and
+        array_hook are called with each decoded dictionary and array, and
+        their results are used in place of the container.
+        """
         handlers = [BooleanHandler(), IntegerHandler(), FloatHandler(),
-                    DateHandler(), DataHander(), StringHandler(),
+                    DateHandler(dates), DataHander(data),
+                    StringHandler(strings),
                     UnicodeStringHandler(), ArrayHandler(self),
                     DictionaryHandler(self), UIDHandler()]
         self.size_handler = UIDHandler()
         self.size_handler.type_number = 1
+        self.encoded_strings = {}
+        self.limit_handler = limit_handler
+        self.depth = 0
+        self.references_on_path = set()
+        self.default = default
+        self.object_hook = object_hook
+        self.array_hook = array_hook
+        self.base_types = {}
+        self.converted = {}
         self.handlers_by_type_number = {}
         self.handlers_by_type = {}
         for handler in handlers:
@@ -362,21 +442,130 @@ class ObjectHandler(object):
         array_handler.set_reference_size(reference_size)
         dict_handler.set_reference_size(reference_size)
     
+    def get_base_type(self, type_):
+        """
+        Return the type a handler is registered for that type_ is, or is a
+        subclass of, or None if there is no such type. The result is cached,
+        so each subclass is only resolved once.
+        """
+        try:
+            return self.base_types[type_]
+        except KeyError:
+            pass
+        base_type = None
+        if type_ in self.handlers_by_type:
+            base_type = type_
+        else:
+            for base in getattr(type_, '__mro__', ()):
+                if base in self.handlers_by_type:
+                    base_type = base
+                    break
+        self.base_types[type_] = base_type
+        return base_type
+    
+    def convert(self, object_):
+        """
+        Return object_ if it can be encoded, or the object default returns
+        for it. The result of default is remembered for each object, so the
+        same object is used every time it is encoded. This is only for
+        collecting objects, where deduplication needs a stable identity.
+        """
+        if self.can_encode(object_):
+            return object_
+        try:
+            return self.converted[id(object_)][1]
+        except KeyError:
+            pass
+        converted = self.apply_default(object_)
+        # keep object_ alive so that its id isn't reused
+        self.converted[id(object_)] = (object_, converted)
+        return converted
+    
+    def apply_default(self, object_):
+        """
+        Return object_ if it can be encoded, or the object default returns
+        for it, without remembering anything.
+        """
+        while not self.can_encode(object_):
+            if self.default is None:
+                raise TypeError('unsupported type: %s' % type(object_))
+            object_ = self.default(object_)
+        return object_
+    
+    def can_encode(self, object_):
+        """Return True if object_ has a type with a handler."""
+        base_type = self.get_base_type(type(object_))
+        return base_type is not None and (base_type is not DATA_TYPE or
+                                          isinstance(object_, Data))
+    
+    def is_container(self, object_):
+        """Return True if object_ is encoded as an array or dictionary."""
+        return self.get_base_type(type(object_)) in (list, tuple, dict)
+    
+    def get_handler(self, object_):
+        """
+        Return the handler for object_, or for the type it is a subclass of.
+        Strings are handled by the string handler if they only hold ASCII
+        characters, and by the unicode string handler otherwise, regardless
+        of their python type.
+        """
+        base_type = self.get_base_type(type(object_))
+        if base_type == str or base_type == unicode:
+            if is_ascii(object_):
+                return self.handlers_by_type[str]
+            return self.handlers_by_type[unicode]
+        if base_type is None:
+            raise TypeError('unsupported type: %s' % type(object_))
+        return self.handlers_by_type[base_type]
+    
     def encode(self, object_, handler=None):
         """Use the appropriate handler to encode the given object."""
         if handler is None:
-            handler = self.handlers_by_type[type(object_)]
+            type_ = type(object_)
+            if type_ == str or type_ == unicode:
+                return self.encode_string(object_)
+            handler = self.get_handler(object_)
         object_length = handler.get_object_length(object_)
         first_byte = self.encode_first_byte(handler.type_number, object_length)
         body = handler.encode_body(object_, object_length)
         return ''.join((first_byte, body))
     
+    def get_encoded_length(self, object_):
+        """
+        Return the number of bytes the given object encodes to, without
+        encoding it. Containers must be flattened and the reference size set.
+        """
+        handler = self.get_handler(object_)
+        object_length = handler.get_object_length(object_)
+        encoded_length = 1 + handler.get_byte_length(object_length)
+        if object_length >= 15 and handler.type_number != 0:
+            size_handler = self.size_handler
+            size_length = size_handler.get_object_length(object_length)
+            encoded_length += 1 + size_handler.get_byte_length(size_length)
+        return encoded_length
+    
+    def encode_string(self, string):
+        """
+        Encode string with the narrowest encoding that can hold it. Short
+        strings, like dictionary keys, are cached once encoded.
+        """
+        key = (type(string), string)
+        encoded = self.encoded_strings.get(key)
+        if encoded is None:
+            encoded = self.encode(string, self.get_handler(string))
+            if (len(string) <= STRING_CACHE_LENGTH and
+                len(self.encoded_strings) < STRING_CACHE_SIZE):
+                self.encoded_strings[key] = encoded
+        return encoded
+    
     def decode(self, file_object, handler=None):
         """Start reading in file_object, and decode the object found."""
         object_type, object_length = self.decode_first_byte(file_object)
         if handler is None:
             handler = self.handlers_by_type_number[object_type]
         byte_length = handler.get_byte_length(object_length)
+        if self.limit_handler is not None:
+            self.limit_handler.check_object(file_object, byte_length)
         raw = file_object.read(byte_length)
         return handler.decode_body(raw, object_length)
     
@@ -384,7 +573,7 @@ class ObjectHandler(object):
         """Flatten all objects in objects."""
         flattened_objects = {}
         for item_index, item in enumerate(objects):
-            if type(item) in (list, dict):
+            if self.is_container(item):
                 flattened = self.flatten(item, objects)
                 flattened_objects.update({item_index: flattened})
         for index, object_ in flattened_objects.items():
@@ -392,16 +581,44 @@ class ObjectHandler(object):
     
     def flatten(self, object_, objects):
         """Flatten the given object, using the appropriate handler."""
-        handler = self.handlers_by_type[type(object_)]
+        handler = self.get_handler(object_)
         return handler.flatten(object_, objects)
     
-    def unflatten(self, object_, objects):
-        """Unflatten the give object, using the appropriate handler."""
+    def unflatten(self, object_, objects, reference=None):
+        """
+        Unflatten the give object, which has the given reference number,
+        using the appropriate handler. With a LimitHandler, every object
+        built is counted, and a reference to a container it is in raises
+        LimitExceededError.
+        """
+        if self.limit_handler is not None:
+            self.limit_handler.check_built(reference)
         if type(object_) in (list, dict):
             handler = self.handlers_by_type[type(object_)]
-            return handler.unflatten(object_, objects)
+            if self.limit_handler is None:
+                return self.apply_hook(handler.unflatten(object_, objects))
+            if reference in self.references_on_path:
+                raise LimitExceededError('reference cycle at object %i' %
+                                         reference)
+            self.depth += 1
+            self.references_on_path.add(reference)
+            try:
+                self.limit_handler.check_depth(self.depth)
+                return self.apply_hook(handler.unflatten(object_, objects))
+            finally:
+                self.depth -= 1
+                self.references_on_path.discard(reference)
         return object_
     
+    def apply_hook(self, container):
+        """Return the decoded container, passed through its hook, if any."""
+        if type(container) == dict:
+            if self.object_hook is not None:
+                return self.object_hook(container)
+        elif self.array_hook is not None:
+            return self.array_hook(container)
+        return container
+    
     def encode_first_byte(self, type_number, length):
         """
         Encode the first byte (or bytes if length is greater than 14) of a an
@@ -436,14 +653,174 @@ class ObjectHandler(object):
         Collect all the objects in object_ into objects, using the appropriate
         handler.
         """
+        object_ = self.convert(object_)
         try:
             find_with_type(object_, objects)
         except ValueError:
             objects.append(object_)
-            if type(object_) in (dict, list):
-                handler = self.handlers_by_type[type(object_)]
+            if self.is_container(object_):
+                handler = self.get_handler(object_)
                 handler.collect_children(object_, objects)
     
+    def order_objects(self, objects, layout, hot_keys=None):
+        """
+        Return the collected objects, which start with the root object,
+        reordered according to layout. In every layout a container's
+        children are placed together, keys before values:
+        
+        'breadth-first': each level of the tree after the one above it.
+        'depth-first': each container's children directly after it, followed
+        by the children of each child container in turn.
+        'hot-keys': like 'depth-first', but the entries of dictionaries with
+        keys in hot_keys are placed first, in the order of hot_keys.
+        """
+        if layout not in ('breadth-first', 'depth-first', 'hot-keys'):
+            raise ValueError('unknown layout: %r' % layout)
+        ranks = {}
+        if layout == 'hot-keys':
+            for rank, key in enumerate(hot_keys or ()):
+                ranks.setdefault(key, rank)
+        order = [0]
+        placed = set(order)
+        pending = [0]
+        while pending:
+            if layout == 'breadth-first':
+                index = pending.pop(0)
+            else:
+                index = pending.pop()
+            new_containers = []
+            for child in self.get_children(objects[index], ranks):
+                child_index = find_with_type(child, objects)
+                if child_index not in placed:
+                    placed.add(child_index)
+                    order.append(child_index)
+                    if self.is_container(child):
+                        new_containers.append(child_index)
+            if layout == 'breadth-first':
+                pending.extend(new_containers)
+            else:
+                pending.extend(reversed(new_containers))
+        return [objects[index] for index in order]
+    
+    def get_children(self, object_, ranks):
+        """
+        Return the children of a container, keys before values, with the
+        entries of a dictionary sorted by the ranks of their keys.
+        """
+        base_type = self.get_base_type(type(object_))
+        if base_type in (list, tuple):
+            return [self.convert(item) for item in object_]
+        if base_type == dict:
+            default = len(ranks)
+            keys = sorted(object_.keys(), key=lambda k: ranks.get(k, default))
+            children = keys + [object_[key] for key in keys]
+            return [self.convert(child) for child in children]
+        return []
+    
+
+class LimitExceededError(ValueError):
+    """Raised when decoding a binary plist would exceed a resource limit."""
+
+
+class LimitHandler(object):
+    """
+    A handler class enforcing resource limits while decoding a binary plist.
+    Each limit is disabled if it is None. Sizes are checked before anything
+    is read, so a plist declaring enormous lengths is rejected without
+    allocating memory for it.
+    """
+    
+    def __init__(self, max_objects=None, max_bytes=None, max_depth=None,
+                 max_object_size=None, timeout=None):
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_object_size = max_object_size
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time() + timeout
+        self.total_bytes = 0
+        self.end_offset = None
+        # the encoded size of each object, by reference number
+        self.object_sizes = []
+        self.objects_built = 0
+        self.bytes_built = 0
+    
+    def check_trailer(self, file_object, trailer):
+        """
+        Check the trailer of file_object against the limits and the size of
+        the file, before the offset table is read.
+        """
+        offset_size, reference_size, length, root, table_offset = trailer
+        if self.max_objects is not None and length > self.max_objects:
+            raise LimitExceededError('%i objects, the limit is %i' %
+                                     (length, self.max_objects))
+        file_object.seek(0, 2)
+        table_end = file_object.tell() - 32
+        if table_offset + offset_size * length > table_end or root >= length:
+            raise LimitExceededError('trailer is out of bounds')
+        self.end_offset = table_offset
+    
+    def check_object(self, file_object, byte_length):
+        """
+        Check an object about to be read from file_object, with the given
+        byte length, against the limits and the end of the objects.
+        """
+        self.check_size(byte_length)
+        if (self.end_offset is not None and
+            file_object.tell() + byte_length > self.end_offset):
+            raise LimitExceededError('object of %i bytes is out of bounds' %
+                                     byte_length)
+        self.check_read(byte_length)
+    
+    def check_size(self, byte_length):
+        """Check the byte length of a single object."""
+        if (self.max_object_size is not None and
+            byte_length > self.max_object_size):
+            raise LimitExceededError('object of %i bytes, the limit is %i' %
+                                     (byte_length, self.max_object_size))
+    
+    def check_read(self, byte_length):
+        """Count byte_length more bytes read, and check the total."""
+        self.total_bytes += byte_length
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            raise LimitExceededError('more than %i bytes decoded' %
+                                     self.max_bytes)
+        self.check_time()
+    
+    def check_built(self, reference=None):
+        """
+        Count an object built from the decoded objects, with the given
+        reference number if it comes from a binary plist. An object shared
+        by several containers is counted every time it is built, so that a
+        small plist can't expand into an enormous tree.
+        """
+        self.objects_built += 1
+        if (self.max_objects is not None and
+            self.objects_built > self.max_objects):
+            raise LimitExceededError('more than %i objects built' %
+                                     self.max_objects)
+        if reference is not None and reference < len(self.object_sizes):
+            self.check_built_bytes(self.object_sizes[reference])
+    
+    def check_built_bytes(self, byte_length):
+        """Count byte_length more bytes of objects built, and check them."""
+        self.bytes_built += byte_length
+        if self.max_bytes is not None and self.bytes_built > self.max_bytes:
+            raise LimitExceededError('more than %i bytes built' %
+                                     self.max_bytes)
+    
+    def check_depth(self, depth):
+        """Check the depth of nesting of a container being unflattened."""
+        if self.max_depth is not None and depth > self.max_depth:
+            raise LimitExceededError('nesting deeper than %i' % self.max_depth)
+        self.check_time()
+    
+    def check_time(self):
+        """Check that the time budget hasn't run out."""
+        if self.deadline is not None and time() > self.deadline:
+            raise LimitExceededError('time budget exceeded')
+    
 
 class TableHandler(object):
     """A handler class for the offset table found in binary plists."""
@@ -496,15 +873,14 @@ class TrailerHandler(object):
         trailer = unpack(self.format, file_object.read())
         return trailer
     
-    def encode(self, offsets, table_offset):
+    def encode(self, offsets, table_offset, root_object=0):
         """
-        Encode the trailer for a binary plist file with given offsets and
-        table_offet.
+        Encode the trailer for a binary plist file with given offsets,
+        table_offet and root object reference.
         """
         offset_size = get_byte_width(table_offset, 4)
         number_of_objects = len(offsets)
-        reference_size = get_byte_width(number_of_objects, 2)
-        root_object = 0
+        reference_size = get_reference_size(number_of_objects)
         return pack(self.format, offset_size, reference_size,
                     number_of_objects, root_object, table_offset)
     
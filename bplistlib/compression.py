@@ -0,0 +1,300 @@
+# encoding: utf-8
+"""
+This file contains private functions and classes for reading and writing
+compressed plists in the bplistlib module.
+
+Besides the stream formats of the standard library (gzip, bz2 and lzma), a
+block compressed format is supported. It stores the plist in independently
+compressed blocks of fixed uncompressed size, followed by an index of the
+blocks and a 32 byte footer. Reading from it only decompresses the blocks
+that are actually touched, so the trailer, the offset table and single
+objects can be read without decompressing the whole file.
+"""
+
+from cStringIO import StringIO
+from struct import pack, unpack
+import bz2
+import gzip
+import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+BLOCK_MAGIC = 'bplistz0'
+BLOCK_SIZE = 0x10000
+# the compressed bytes fed to a decompressor at a time under limits
+LIMITED_CHUNK_SIZE = 0x100
+FOOTER_FORMAT = '>B3xLQQQ'
+INDEX_FORMAT = '>QL'
+CODECS = ('zlib', 'bz2', 'lzma')
+MAGIC_NUMBERS = (('\x1f\x8b', 'gzip'), ('BZh', 'bz2'),
+                 ('\xfd7zXZ\x00', 'lzma'), (BLOCK_MAGIC, 'block'))
+
+
+def detect_compression(file_object):
+    """
+    Return the name of the compression used by file_object, or None if it
+    is not compressed. The file position is reset to the start afterwards.
+    """
+    magic = file_object.read(8)
+    file_object.seek(0)
+    for prefix, compression in MAGIC_NUMBERS:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def open_compressed(file_object, compression=None, limit_handler=None):
+    """
+    Return a seekable file-like object with the decompressed contents of
+    file_object. If compression is None, detect it, and return file_object
+    itself if it isn't compressed. If a LimitHandler is given, a stream
+    compressed file is decompressed a little at a time, and the bytes that
+    come out are checked with it as they are produced.
+    """
+    if compression is None:
+        compression = detect_compression(file_object)
+    if compression is None:
+        return file_object
+    if compression == 'block':
+        return BlockReader(file_object)
+    if limit_handler is not None:
+        return StringIO(decompress_limited(file_object, compression,
+                                           limit_handler))
+    if compression == 'gzip':
+        return StringIO(gzip.GzipFile(fileobj=file_object).read())
+    module = get_stream_module(compression)
+    return StringIO(module.decompress(file_object.read()))
+
+
+def decompress_limited(file_object, compression, limit_handler):
+    """
+    Decompress the stream compressed contents of file_object, checking the
+    length of each piece of output with limit_handler before the next
+    piece is decompressed.
+    """
+    if compression == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        module = get_stream_module(compression)
+        if module is bz2:
+            decompressor = bz2.BZ2Decompressor()
+        else:
+            decompressor = module.LZMADecompressor()
+    chunks = []
+    while True:
+        compressed = file_object.read(LIMITED_CHUNK_SIZE)
+        if not compressed:
+            break
+        while compressed:
+            if compression == 'gzip':
+                # zlib can bound the output of each step itself
+                chunk = decompressor.decompress(compressed, BLOCK_SIZE)
+                compressed = decompressor.unconsumed_tail
+            else:
+                chunk = decompressor.decompress(compressed)
+                compressed = ''
+            limit_handler.check_read(len(chunk))
+            chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def create_compressed(file_object, compression):
+    """
+    Return a writable file-like object that compresses everything written
+    to it into file_object. It must be closed to finish the compressed
+    stream, which leaves file_object open.
+    """
+    if compression == 'block':
+        return BlockWriter(file_object)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file_object, mode='wb')
+    module = get_stream_module(compression)
+    if module is bz2:
+        return CompressedWriter(file_object, bz2.BZ2Compressor())
+    return CompressedWriter(file_object, module.LZMACompressor())
+
+
+def get_stream_module(compression):
+    """
+    Return the module implementing a stream compression other than gzip, or
+    raise ValueError. Raw zlib streams have no magic number to detect them
+    by, so zlib is only used for the blocks of the block format.
+    """
+    if compression == 'zlib':
+        raise ValueError('zlib is only supported within block compression')
+    return get_codec_module(compression)
+
+
+def get_codec_module(codec):
+    """Return the module implementing codec, or raise ValueError."""
+    if codec == 'xz':
+        codec = 'lzma'
+    if codec == 'zlib':
+        return zlib
+    if codec == 'bz2':
+        return bz2
+    if codec == 'lzma':
+        if lzma is None:
+            raise ValueError('lzma compression is not available')
+        return lzma
+    raise ValueError('unknown compression: %r' % codec)
+
+
+class CompressedWriter(object):
+    """A write only file-like object feeding a compressor object."""
+
+    def __init__(self, file_object, compressor):
+        self.file_object = file_object
+        self.compressor = compressor
+        self.position = 0
+
+    def write(self, string):
+        """Compress string and write the output to the file object."""
+        self.position += len(string)
+        self.file_object.write(self.compressor.compress(string))
+
+    def tell(self):
+        """Return the uncompressed position."""
+        return self.position
+
+    def close(self):
+        """Flush the compressor, leaving the file object open."""
+        if self.compressor is not None:
+            self.file_object.write(self.compressor.flush())
+            self.compressor = None
+
+
+class BlockWriter(object):
+    """A write only file-like object writing the block compressed format."""
+
+    def __init__(self, file_object, codec='zlib', block_size=BLOCK_SIZE):
+        self.file_object = file_object
+        self.codec = CODECS.index(codec)
+        self.module = get_codec_module(codec)
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.position = 0
+        self.blocks = []
+        self.closed = False
+        file_object.write(BLOCK_MAGIC)
+
+    def write(self, string):
+        """Buffer string, compressing any blocks that are complete."""
+        self.buffer.append(string)
+        self.buffered += len(string)
+        self.position += len(string)
+        if self.buffered >= self.block_size:
+            self.flush_blocks(final=False)
+
+    def tell(self):
+        """Return the uncompressed position."""
+        return self.position
+
+    def flush_blocks(self, final):
+        """
+        Compress and write every full block in the buffer. If final is True,
+        also write the last, partial, block.
+        """
+        data = ''.join(self.buffer)
+        start = 0
+        while (len(data) - start >= self.block_size or
+               (final and start < len(data))):
+            block = data[start:start + self.block_size]
+            compressed = self.module.compress(block)
+            self.blocks.append((self.file_object.tell(), len(compressed)))
+            self.file_object.write(compressed)
+            start += len(block)
+        remainder = data[start:]
+        self.buffer = [remainder]
+        self.buffered = len(remainder)
+
+    def close(self):
+        """Write the remaining data, the index and the footer."""
+        if self.closed:
+            return
+        self.flush_blocks(final=True)
+        index_offset = self.file_object.tell()
+        for entry in self.blocks:
+            self.file_object.write(pack(INDEX_FORMAT, *entry))
+        self.file_object.write(pack(FOOTER_FORMAT, self.codec,
+                                    self.block_size, len(self.blocks),
+                                    self.position, index_offset))
+        self.closed = True
+
+
+class BlockReader(object):
+    """
+    A read only, seekable, file-like object over the block compressed
+    format. Blocks are decompressed on demand, and the last few are cached.
+    """
+
+    def __init__(self, file_object, cache_size=4):
+        self.file_object = file_object
+        footer_size = len(pack(FOOTER_FORMAT, 0, 0, 0, 0, 0))
+        file_object.seek(-footer_size, 2)
+        footer = unpack(FOOTER_FORMAT, file_object.read(footer_size))
+        codec, self.block_size, block_count, self.size, index_offset = footer
+        self.module = get_codec_module(CODECS[codec])
+        entry_size = len(pack(INDEX_FORMAT, 0, 0))
+        file_object.seek(index_offset)
+        raw = file_object.read(entry_size * block_count)
+        self.blocks = [unpack(INDEX_FORMAT, raw[i:i + entry_size])
+                       for i in range(0, len(raw), entry_size)]
+        self.cache_size = cache_size
+        self.cache = {}
+        self.cache_order = []
+        self.position = 0
+
+    def get_block(self, number):
+        """Return the decompressed block with the given number."""
+        if number in self.cache:
+            return self.cache[number]
+        offset, length = self.blocks[number]
+        self.file_object.seek(offset)
+        block = self.module.decompress(self.file_object.read(length))
+        self.cache[number] = block
+        self.cache_order.append(number)
+        if len(self.cache_order) > self.cache_size:
+            del self.cache[self.cache_order.pop(0)]
+        return block
+
+    def read(self, size=-1):
+        """Read up to size uncompressed bytes, or everything if size < 0."""
+        if size < 0:
+            size = self.size - self.position
+        size = max(min(size, self.size - self.position), 0)
+        chunks = []
+        while size > 0:
+            number, start = divmod(self.position, self.block_size)
+            chunk = self.get_block(number)[start:start + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        """Seek in the uncompressed data, like file.seek."""
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError('negative seek position')
+        self.position = offset
+
+    def tell(self):
+        """Return the uncompressed position."""
+        return self.position
+
+    def close(self):
+        """Drop the cached blocks. The file object is left open."""
+        self.cache = {}
+        self.cache_order = []
+
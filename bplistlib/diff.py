@@ -0,0 +1,189 @@
+# encoding: utf-8
+"""
+This file contains the object level diff of binary plists for the bplistlib
+module.
+
+Every object is hashed from its encoded bytes, going through the offset
+tables of both files, with containers hashed from the hashes of their
+children. Only where the hashes of two objects differ does the diff descend
+into them, and only the values that actually changed are decoded.
+"""
+
+from hashlib import md5
+from .compression import open_compressed
+from .readwrite import ObjectReader
+
+
+def diff(a, b):
+    """
+    Compare the binary plists a and b, each a path or an open file object,
+    and yield a (change, key_path, old, new) tuple for every difference.
+    change is 'added', 'removed' or 'changed', key_path is a tuple of
+    dictionary keys and array indices, and old or new is None for added and
+    removed objects.
+    """
+    files = []
+    try:
+        readers = []
+        for path_or_file in (a, b):
+            if isinstance(path_or_file, (str, unicode)):
+                path_or_file = open(path_or_file, 'rb')
+                files.append(path_or_file)
+            readers.append(HashingReader(open_compressed(path_or_file)))
+        reader_a, reader_b = readers
+        for change in diff_references(reader_a, reader_a.root,
+                                      reader_b, reader_b.root, ()):
+            yield change
+    finally:
+        for file_object in files:
+            file_object.close()
+
+
+class HashingReader(ObjectReader):
+    """An ObjectReader that hashes objects from their encoded bytes."""
+
+    def __init__(self, file_object):
+        ObjectReader.__init__(self, file_object)
+        self.hashes = {}
+
+    def get_hash(self, reference):
+        """
+        Return the hash of the object with the given reference number. Leaves
+        are hashed from their encoded bytes, and containers from the hashes
+        of their children, so that equal trees hash equally no matter how
+        their objects are numbered. Only the reference lists of containers
+        are decoded. Containers are walked with a stack, and a container
+        that contains itself raises ValueError.
+        """
+        if reference in self.hashes:
+            return self.hashes[reference]
+        root = reference
+        root_node = self.read_node(root)
+        on_path = set([root])
+        stack = [(root, root_node, iter(root_node[1]))]
+        while stack:
+            reference, node, children = stack[-1]
+            for child in children:
+                if child in self.hashes:
+                    continue
+                if child in on_path:
+                    raise ValueError('reference cycle at object %i' % child)
+                on_path.add(child)
+                child_node = self.read_node(child)
+                stack.append((child, child_node, iter(child_node[1])))
+                break
+            else:
+                stack.pop()
+                on_path.discard(reference)
+                self.hashes[reference] = self.hash_node(node)
+        return self.hashes[root]
+
+    def read_node(self, reference):
+        """
+        Return the type number of an object and, for an array or a
+        dictionary, the references it holds, keys before values, or an
+        empty tuple and its encoded bytes for any other object. Nothing but
+        reference lists is decoded.
+        """
+        offset = self.offsets[reference]
+        self.file_object.seek(offset)
+        object_handler = self.object_handler
+        type_number, object_length = object_handler.decode_first_byte(
+            self.file_object)
+        handler = object_handler.handlers_by_type_number[type_number]
+        byte_length = handler.get_byte_length(object_length)
+        if type_number in (0xa, 0xd):
+            array_handler = object_handler.handlers_by_type[list]
+            raw = self.file_object.read(byte_length)
+            count = byte_length // array_handler.reference_size
+            return type_number, array_handler.decode_body(raw, count), None
+        length = self.file_object.tell() - offset + byte_length
+        self.file_object.seek(offset)
+        return type_number, (), self.file_object.read(length)
+
+    def hash_node(self, node):
+        """Hash an object read by read_node, once its children are hashed."""
+        type_number, references, raw = node
+        if type_number == 0xa:
+            children = [self.hashes[item] for item in references]
+            return md5('a' + ''.join(children)).digest()
+        if type_number == 0xd:
+            count = len(references) // 2
+            entries = sorted(self.hashes[key] + self.hashes[value]
+                             for key, value in zip(references[:count],
+                                                   references[count:]))
+            return md5('d' + ''.join(entries)).digest()
+        return md5(raw).digest()
+
+
+def diff_references(reader_a, reference_a, reader_b, reference_b, key_path):
+    """
+    Yield the differences between two objects, descending where their
+    hashes differ. The pairs of objects still to compare are kept on a
+    stack, in order with the changes already found.
+    """
+    stack = [(reference_a, reference_b, key_path)]
+    while stack:
+        item = stack.pop()
+        if len(item) == 4:
+            yield item
+        else:
+            reference_a, reference_b, key_path = item
+            stack.extend(reversed(compare(reader_a, reference_a, reader_b,
+                                          reference_b, key_path)))
+
+
+def compare(reader_a, reference_a, reader_b, reference_b, key_path):
+    """
+    Compare two objects one level down, and return a list of the changes
+    found, as (change, key_path, old, new) tuples, and of the pairs of
+    children to compare next, as (reference_a, reference_b, key_path)
+    tuples, in the order the diff yields them.
+    """
+    if reader_a.get_hash(reference_a) == reader_b.get_hash(reference_b):
+        return []
+    object_a = reader_a.read_flat(reference_a)
+    object_b = reader_b.read_flat(reference_b)
+    items = []
+    if type(object_a) == dict and type(object_b) == dict:
+        entries_a = get_entries(reader_a, object_a)
+        entries_b = get_entries(reader_b, object_b)
+        for key_hash, (key, value) in entries_a.iteritems():
+            if key_hash not in entries_b:
+                items.append(('removed', key_path + (reader_a.read_flat(key),),
+                              reader_a.read_object(value), None))
+        for key_hash, (key, value_b) in entries_b.iteritems():
+            if key_hash not in entries_a:
+                items.append(('added', key_path + (reader_b.read_flat(key),),
+                              None, reader_b.read_object(value_b)))
+                continue
+            value_a = entries_a[key_hash][1]
+            # keys are only decoded on the way to a change
+            if reader_a.get_hash(value_a) != reader_b.get_hash(value_b):
+                items.append((value_a, value_b,
+                              key_path + (reader_b.read_flat(key),)))
+    elif type(object_a) == list and type(object_b) == list:
+        for index, (item_a, item_b) in enumerate(zip(object_a, object_b)):
+            if reader_a.get_hash(item_a) != reader_b.get_hash(item_b):
+                items.append((item_a, item_b, key_path + (index,)))
+        for index in range(len(object_b), len(object_a)):
+            items.append(('removed', key_path + (index,),
+                          reader_a.read_object(object_a[index]), None))
+        for index in range(len(object_a), len(object_b)):
+            items.append(('added', key_path + (index,), None,
+                          reader_b.read_object(object_b[index])))
+    else:
+        old = reader_a.read_object(reference_a)
+        new = reader_b.read_object(reference_b)
+        if type(old) != type(new) or old != new:
+            items.append(('changed', key_path, old, new))
+    return items
+
+
+def get_entries(reader, dictionary):
+    """
+    Return a dictionary mapping the hash of each key of a flattened
+    dictionary to the key and value references.
+    """
+    return dict((reader.get_hash(key), (key, value))
+                for key, value in dictionary.iteritems())
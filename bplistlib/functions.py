@@ -13,6 +13,29 @@ def get_byte_width(value_to_store, max_byte_width):
     raise ValueError
 
 
+def get_reference_size(number_of_objects):
+    """
+    Return the number of bytes used for each reference in a binary plist
+    with number_of_objects objects. This is always 1, 2, 4 or 8.
+    """
+    byte_width = get_byte_width(number_of_objects, 8)
+    for reference_size in (1, 2, 4, 8):
+        if byte_width <= reference_size:
+            return reference_size
+
+
+def is_ascii(string):
+    """Return True if the str or unicode string only holds ASCII characters."""
+    try:
+        if type(string) == unicode:
+            string.encode('ascii')
+        else:
+            string.decode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
 def find_with_type(value, list_):
     """
     Find value in list_, matching both for equality and type, and
@@ -39,6 +62,6 @@ def unflatten_reference_list(references, objects, object_handler):
     object_list = []
     for reference in references:
         item = objects[reference]
-        item = object_handler.unflatten(item, objects)
+        item = object_handler.unflatten(item, objects, reference)
         object_list.append(item)
     return object_list
@@ -0,0 +1,260 @@
+# encoding: utf-8
+"""
+This file contains the sidecar key path index for the bplistlib module.
+
+An index file maps every key path in a binary plist to the reference number
+and byte offset of the object found there. It is stored in an open
+addressing hash table, which is memory mapped and probed directly, so a
+lookup costs the same no matter how large the plist is. The index records
+the size, modification time and trailer of the plist it was built from, and
+is ignored once any of those change.
+
+To build the index for one or more plists from the command line:
+
+    python -m bplistlib.index path [path ...]
+"""
+
+from hashlib import md5
+from mmap import mmap, ACCESS_READ
+from os import stat
+from struct import pack, unpack, unpack_from, calcsize
+import sys
+from .compression import open_compressed
+from .readwrite import ObjectReader
+
+
+INDEX_MAGIC = 'bpindex0'
+INDEX_SUFFIX = '.index'
+HEADER_FORMAT = '>8sQd32sQQ'
+SLOT_FORMAT = '>QQLQQ'
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+SLOT_SIZE = calcsize(SLOT_FORMAT)
+
+
+def get_index_path(path):
+    """Return the default path of the index file for the plist at path."""
+    return path + INDEX_SUFFIX
+
+
+def encode_key_path(key_path):
+    """
+    Encode a sequence of dictionary keys and array indices as the string
+    stored in the index.
+    """
+    parts = []
+    for key in key_path:
+        if isinstance(key, unicode):
+            parts.append('k' + key.encode('utf_8'))
+        elif isinstance(key, str):
+            parts.append('k' + key)
+        elif isinstance(key, (int, long)):
+            parts.append('i%i' % key)
+        else:
+            parts.append('k' + repr(key))
+    return '\x00'.join(parts)
+
+
+def hash_key_path(encoded):
+    """Return the non zero 64 bit hash of an encoded key path."""
+    value = unpack('>Q', md5(encoded).digest()[:8])[0]
+    return value or 1
+
+
+def get_identity(path, file_object):
+    """
+    Return the size, modification time and trailer identifying the plist at
+    path, which is open as file_object.
+    """
+    status = stat(path)
+    file_object.seek(-32, 2)
+    trailer = file_object.read(32)
+    return status.st_size, status.st_mtime, trailer
+
+
+def collect_entries(reader):
+    """
+    Walk every object reachable from the root of the ObjectReader reader,
+    and return a list of (encoded key path, reference, offset) entries.
+    Raise ValueError if a reference refers back to an object it is in.
+    """
+    root = reader.root
+    entries = [(encode_key_path(()), root, reader.offsets[root])]
+    on_path = set([root])
+    stack = [((), root, iter(get_children(reader, root)))]
+    while stack:
+        key_path, reference, children = stack[-1]
+        for key, child in children:
+            if child in on_path:
+                raise ValueError('reference cycle at object %i' % child)
+            child_path = key_path + (key,)
+            entries.append((encode_key_path(child_path), child,
+                            reader.offsets[child]))
+            on_path.add(child)
+            stack.append((child_path, child,
+                          iter(get_children(reader, child))))
+            break
+        else:
+            on_path.discard(reference)
+            stack.pop()
+    return entries
+
+
+def get_children(reader, reference):
+    """
+    Return a list of (key, reference) pairs for the items of an array or
+    the entries of a dictionary, or an empty list for any other object.
+    """
+    container = reader.read_flat(reference)
+    if type(container) == list:
+        return list(enumerate(container))
+    if type(container) == dict:
+        return [(reader.read_flat(key_reference), value_reference)
+                for key_reference, value_reference in container.items()]
+    return []
+
+
+def build_index(path, index_path=None):
+    """
+    Build the index for the binary plist at path, and write it to
+    index_path, which defaults to the plist path with '.index' appended.
+    Return the number of key paths indexed.
+    """
+    if index_path is None:
+        index_path = get_index_path(path)
+    with open(path, 'rb') as file_object:
+        plist = open_compressed(file_object)
+        size, mtime, trailer = get_identity(path, plist)
+        entries = collect_entries(ObjectReader(plist))
+    slot_count = 1
+    while slot_count < len(entries) * 2:
+        slot_count *= 2
+    slots = [None] * slot_count
+    pool = []
+    pool_offset = 0
+    for encoded, reference, offset in entries:
+        hash_ = hash_key_path(encoded)
+        slot = hash_ % slot_count
+        while slots[slot] is not None:
+            slot = (slot + 1) % slot_count
+        slots[slot] = (hash_, pool_offset, len(encoded), reference, offset)
+        pool.append(encoded)
+        pool_offset += len(encoded)
+    empty = pack(SLOT_FORMAT, 0, 0, 0, 0, 0)
+    with open(index_path, 'wb') as index_file:
+        index_file.write(pack(HEADER_FORMAT, INDEX_MAGIC, size, mtime,
+                              trailer, slot_count, len(entries)))
+        for slot in slots:
+            if slot is None:
+                index_file.write(empty)
+            else:
+                index_file.write(pack(SLOT_FORMAT, *slot))
+        for encoded in pool:
+            index_file.write(encoded)
+    return len(entries)
+
+
+class KeyPathIndex(object):
+    """A memory mapped, read only, sidecar key path index."""
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as index_file:
+            self.map = mmap(index_file.fileno(), 0, access=ACCESS_READ)
+        header = unpack_from(HEADER_FORMAT, self.map)
+        magic, size, mtime, trailer, slot_count, length = header
+        if magic != INDEX_MAGIC:
+            raise ValueError('not a bplistlib index: %r' % index_path)
+        self.identity = size, mtime, trailer
+        self.slot_count = slot_count
+        self.length = length
+        self.pool_offset = HEADER_SIZE + slot_count * SLOT_SIZE
+
+    def __len__(self):
+        return self.length
+
+    def is_valid(self, path, plist=None):
+        """
+        Return True if the index matches the current plist at path. plist
+        is the plist, already open and decompressed, if it is at hand.
+        """
+        if plist is None:
+            with open(path, 'rb') as file_object:
+                return self.is_valid(path, open_compressed(file_object))
+        return get_identity(path, plist) == self.identity
+
+    def lookup(self, key_path):
+        """
+        Return the (reference, offset) pair of the object at key_path. Raise
+        KeyError if the key path is not in the index.
+        """
+        encoded = encode_key_path(key_path)
+        hash_ = hash_key_path(encoded)
+        slot = hash_ % self.slot_count
+        while True:
+            entry = unpack_from(SLOT_FORMAT, self.map,
+                                HEADER_SIZE + slot * SLOT_SIZE)
+            slot_hash, string_offset, string_length, reference, offset = entry
+            if slot_hash == 0:
+                raise KeyError(key_path)
+            if slot_hash == hash_:
+                start = self.pool_offset + string_offset
+                if self.map[start:start + string_length] == encoded:
+                    return reference, offset
+            slot = (slot + 1) % self.slot_count
+
+    def close(self):
+        """Unmap the index file."""
+        self.map.close()
+
+
+def open_index(path, index_path=None, plist=None):
+    """
+    Return the KeyPathIndex for the plist at path, or None if there is no
+    index or it is out of date. plist is passed on to KeyPathIndex.is_valid.
+    """
+    if index_path is None:
+        index_path = get_index_path(path)
+    try:
+        index = KeyPathIndex(index_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if not index.is_valid(path, plist):
+        index.close()
+        return None
+    return index
+
+
+def query(path, key_path, index_path=None):
+    """
+    Return the object at key_path, a sequence of dictionary keys and array
+    indices, in the binary plist at path. Only the objects under key_path,
+    and their entries in the offset table, are read. If an up to date index
+    exists it is used to go to the object directly, otherwise the key path
+    is followed from the root. Raise KeyError if there is no object at
+    key_path.
+    """
+    with open(path, 'rb') as file_object:
+        plist = open_compressed(file_object)
+        index = open_index(path, index_path, plist)
+        reader = ObjectReader(plist, lazy=True)
+        if index is None:
+            return reader.read_object(reader.find(key_path))
+        try:
+            reference, offset = index.lookup(key_path)
+        finally:
+            index.close()
+        return reader.read_object(reference, offset)
+
+
+def main(arguments):
+    """Build the index for each plist path in arguments."""
+    if not arguments:
+        sys.stderr.write('usage: python -m bplistlib.index path [path ...]\n')
+        return 2
+    for path in arguments:
+        length = build_index(path)
+        sys.stdout.write('%s: %i key paths\n' % (get_index_path(path), length))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
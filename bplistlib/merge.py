@@ -0,0 +1,170 @@
+# encoding: utf-8
+"""
+This file contains the merging of binary plists for the bplistlib module.
+
+merge() combines binary plists into a single array or dictionary plist
+without decoding any values. The encoded bytes of every leaf object are
+copied as they are, and only the reference lists of containers are
+rewritten, to the numbering of the merged plist, along with the offset
+table and the trailer.
+"""
+
+from array import array
+from hashlib import md5
+from .classes import ObjectHandler
+from .compression import open_compressed
+from .functions import get_reference_size
+from .readwrite import ObjectReader, write_table, write_trailer
+
+
+def merge(inputs, file_object, into='array', keys=None, dedupe=False):
+    """
+    Write a binary plist to file_object holding the root objects of the
+    binary plists in inputs, each a path or an open file object. If into
+    is 'array', the root objects are the items of an array, in order. If it
+    is 'dict', they are the values of a dictionary, with keys given in the
+    same order by keys, which defaults to the paths of the inputs. If dedupe
+    is True, identical leaf objects are written only once. Return the
+    number of objects written.
+    """
+    if into not in ('array', 'dict'):
+        raise ValueError('into must be \'array\' or \'dict\', not %r' % into)
+    if into == 'dict':
+        keys = get_keys(inputs, keys)
+    files = []
+    try:
+        readers = []
+        for path_or_file in inputs:
+            if isinstance(path_or_file, (str, unicode)):
+                path_or_file = open(path_or_file, 'rb')
+                files.append(path_or_file)
+            readers.append(ObjectReader(open_compressed(path_or_file)))
+        plist_merger = PlistMerger(file_object, dedupe)
+        return plist_merger.merge(readers, keys)
+    finally:
+        for input_file in files:
+            input_file.close()
+
+
+def get_keys(inputs, keys):
+    """Return the dictionary keys for the inputs of a merge into='dict'."""
+    if keys is None:
+        keys = []
+        for path_or_file in inputs:
+            if not isinstance(path_or_file, (str, unicode)):
+                path_or_file = getattr(path_or_file, 'name', None)
+            if not isinstance(path_or_file, (str, unicode)):
+                raise ValueError('keys are needed for inputs without paths')
+            keys.append(path_or_file)
+    keys = list(keys)
+    if len(keys) != len(inputs):
+        raise ValueError('expected %i keys, got %i' %
+                         (len(inputs), len(keys)))
+    if len(set(keys)) != len(keys):
+        raise ValueError('duplicate keys')
+    return keys
+
+
+class PlistMerger(object):
+    """
+    Merge the objects of several ObjectReaders into one binary plist.
+
+    Leaf objects are copied to the output as they are numbered. Containers
+    are numbered with them but written after all the leaves, once the
+    number of objects, and so the reference size, is known.
+    """
+
+    def __init__(self, file_object, dedupe=False):
+        self.file_object = file_object
+        self.dedupe = dedupe
+        self.object_handler = ObjectHandler()
+        self.offsets = array('L')
+        self.hashes = {}
+
+    def merge(self, readers, keys=None):
+        """
+        Write the merged plist, with the root objects of the readers in an
+        array, or in a dictionary if keys is given. Return the number of
+        objects written.
+        """
+        self.file_object.write('bplist00')
+        # the merged root container is object 0, written last
+        self.offsets.append(0)
+        references = []
+        if keys is not None:
+            for key in keys:
+                encoded_key = self.object_handler.encode(key)
+                references.append(self.add_leaf(encoded_key))
+        mappings = []
+        containers = []
+        for index, reader in enumerate(readers):
+            mapping = array('L')
+            for reference in range(len(reader.offsets)):
+                raw = reader.read_raw(reference)
+                if ord(raw[0]) >> 4 in (0xa, 0xd):
+                    mapping.append(len(self.offsets))
+                    self.offsets.append(0)
+                    containers.append((index, reference))
+                else:
+                    mapping.append(self.add_leaf(raw))
+            mappings.append(mapping)
+            references.append(mapping[reader.root])
+        self.object_handler.set_reference_size(
+            get_reference_size(len(self.offsets)))
+        for index, reference in containers:
+            type_number, old_references = self.read_references(
+                readers[index], reference)
+            mapping = mappings[index]
+            self.write_container(mapping[reference], type_number,
+                                 [mapping[item] for item in old_references])
+        if keys is None:
+            self.write_container(0, 0xa, references)
+        else:
+            self.write_container(0, 0xd, references)
+        table_offset = write_table(self.file_object, self.offsets)
+        write_trailer(self.file_object, self.offsets, table_offset)
+        return len(self.offsets)
+
+    def add_leaf(self, raw):
+        """
+        Write the encoded leaf object raw and return its new reference, or
+        the reference of an identical object if deduplicating.
+        """
+        if self.dedupe:
+            digest = md5(raw).digest()
+            reference = self.hashes.get(digest)
+            if reference is not None:
+                return reference
+            self.hashes[digest] = len(self.offsets)
+        self.offsets.append(self.file_object.tell())
+        self.file_object.write(raw)
+        return len(self.offsets) - 1
+
+    def read_references(self, reader, reference):
+        """
+        Return the type number and the reference list, in order, of a
+        container in the plist of reader, keys before values for a
+        dictionary.
+        """
+        reader.file_object.seek(reader.offsets[reference])
+        object_handler = reader.object_handler
+        type_number, object_length = object_handler.decode_first_byte(
+            reader.file_object)
+        handler = object_handler.handlers_by_type_number[type_number]
+        byte_length = handler.get_byte_length(object_length)
+        array_handler = object_handler.handlers_by_type[list]
+        raw = reader.file_object.read(byte_length)
+        count = byte_length // array_handler.reference_size
+        return type_number, array_handler.decode_body(raw, count)
+
+    def write_container(self, reference, type_number, references):
+        """Write a container with the given, rewritten, reference list."""
+        length = len(references)
+        if type_number == 0xd:
+            length = length // 2
+        self.offsets[reference] = self.file_object.tell()
+        object_handler = self.object_handler
+        array_handler = object_handler.handlers_by_type[list]
+        first_byte = object_handler.encode_first_byte(type_number, length)
+        body = array_handler.encode_body(references, len(references))
+        self.file_object.write(first_byte + body)
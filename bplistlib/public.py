@@ -3,8 +3,10 @@
 
 
 from cStringIO import StringIO
-import plistlib
-from .readwrite import read, write
+from .classes import LimitHandler
+from .readwrite import read, write, write_stream, make_plan
+from .compression import open_compressed, create_compressed
+from .xmlplist import read_xml, write_xml, convert_to_binary, convert_to_xml
 
 
 #########
@@ -12,20 +14,53 @@ from .readwrite import read, write
 #########
 
 
-def dump(obj, fp, binary=False):
-    if binary is True:
-        write(obj, fp)
+def dump(obj, fp, binary=False, compression=None, stream=False, layout=None,
+         hot_keys=None, default=None, plan=None):
+    if plan is not None and (binary is not True or stream is True):
+        raise ValueError('a plan can only be used to write a binary plist '
+                         'without streaming')
+    if compression is not None:
+        compressed_fp = create_compressed(fp, compression)
+        dump(obj, compressed_fp, binary, stream=stream, layout=layout,
+             hot_keys=hot_keys, default=default, plan=plan)
+        compressed_fp.close()
+    elif stream is True:
+        write_stream(obj, fp, default)
+    elif binary is True:
+        write(obj, fp, layout, hot_keys, default, plan)
     else:
-        plistlib.writePlist(obj, fp)
+        write_xml(obj, fp, default)
 
 
-def dumps(obj, binary=False):
+def dumps(obj, binary=False, compression=None, stream=False, layout=None,
+          hot_keys=None, default=None, plan=None):
     fp = StringIO()
-    dump(obj, fp, binary)
+    dump(obj, fp, binary, compression, stream, layout, hot_keys, default,
+         plan)
     return fp.getvalue()
 
 
-def load(fp, binary=None):
+def estimate(obj, layout=None, hot_keys=None, default=None):
+    """
+    Work out the binary plist obj would be written as, without writing it.
+    Return a WritePlan, with the exact size in bytes as size, the number of
+    objects as object_count, the sizes of offsets and references as
+    offset_size and reference_size, and whether the plist can be written as
+    fits. The plan can be passed to dump() or dumps() as plan to write obj
+    without collecting its objects again, as long as obj is unchanged.
+    """
+    plan = make_plan(obj, layout, hot_keys, default)
+    plan.measure()
+    return plan
+
+
+def load(fp, binary=None, compression=None, processes=None,
+         dates='datetime', data='Data', strings='str', limits=None,
+         object_hook=None, array_hook=None):
+    if limits is None:
+        fp = open_compressed(fp, compression)
+    else:
+        fp = open_compressed(fp, compression, LimitHandler(**limits))
     if binary is None:
         if fp.read(8) == 'bplist00':
             binary = True
@@ -33,14 +68,47 @@ def load(fp, binary=None):
             fp.seek(0)  # I'm not sure if this is necessary
             binary = False
     if binary is True:
-        root_object = read(fp)
+        root_object = read(fp, processes, dates=dates, data=data,
+                           strings=strings, limits=limits,
+                           object_hook=object_hook, array_hook=array_hook)
     elif binary is False:
-        root_object = plistlib.readPlist(fp)    
+        limit_handler = None
+        if limits is not None:
+            limit_handler = LimitHandler(**limits)
+        root_object = read_xml(fp, dates, data, strings, object_hook,
+                               array_hook, limit_handler)
     return root_object
 
 
-def loads(s, binary=None):
-    return load(StringIO(s), binary)
+def loads(s, binary=None, compression=None, dates='datetime', data='Data',
+          strings='str', limits=None, object_hook=None, array_hook=None):
+    return load(StringIO(s), binary, compression, dates=dates, data=data,
+                strings=strings, limits=limits, object_hook=object_hook,
+                array_hook=array_hook)
+
+
+def convert(input_fp, output_fp, binary=None, compression=None):
+    """
+    Convert the plist in input_fp to output_fp. If binary is None, write
+    the other format, otherwise write a binary plist if binary is True and
+    an XML plist if it is False. Conversions between formats are streamed
+    object by object, without building the whole tree.
+    """
+    input_fp = open_compressed(input_fp)
+    input_binary = input_fp.read(8) == 'bplist00'
+    input_fp.seek(0)
+    if binary is None:
+        binary = not input_binary
+    if compression is not None:
+        compressed_fp = create_compressed(output_fp, compression)
+        convert(input_fp, compressed_fp, binary)
+        compressed_fp.close()
+    elif binary == input_binary:
+        dump(load(input_fp, input_binary, dates='utc'), output_fp, binary)
+    elif binary is True:
+        convert_to_binary(input_fp, output_fp)
+    else:
+        convert_to_xml(input_fp, output_fp)
 
 
 ################
@@ -48,33 +116,65 @@ def loads(s, binary=None):
 ################
 
 
-def readPlist(path_or_file, binary=None):
+def readPlist(path_or_file, binary=None, compression=None, processes=None,
+              dates='datetime', data='Data', strings='str', cache=None,
+              limits=None, object_hook=None, array_hook=None):
     """
     Read a plist from path_or_file. If the named argument binary is set to
     True, then assume path_or_file is a binary plist. If it's set to false,
     then assume it's an xml plist. Otherwise, try to detect the type and act
-    accordingly. Return the root object.
+    accordingly. Compressed files are detected in the same way, unless
+    compression names the format to expect. If processes is given, large
+    binary plists are decoded in parallel. The dates, data and strings
+    arguments select the form binary dates, data and ASCII strings are
+    decoded to. If cache is a PlistCache and path_or_file is a path, the
+    parsed plist is cached there. If limits is given, decoding the plist
+    is checked against it. object_hook and array_hook are called with
+    each decoded dictionary and array, and their results are used in place
+    of the container. Return the root object.
     """
+    if cache is not None and isinstance(path_or_file, (str, unicode)):
+        options = (binary, compression, dates, data, strings,
+                   limits and tuple(sorted(limits.items())), object_hook,
+                   array_hook)
+        load_path = lambda path: readPlist(path, binary, compression,
+                                           processes, dates, data, strings,
+                                           limits=limits,
+                                           object_hook=object_hook,
+                                           array_hook=array_hook)
+        return cache.get(path_or_file, load_path, options)
     did_open = False
     if isinstance(path_or_file, (str, unicode)):
-        path_or_file = open(path_or_file)
+        path_or_file = open(path_or_file, 'rb')
         did_open = True
-    root_object = load(path_or_file, binary)
+    root_object = load(path_or_file, binary, compression, processes, dates,
+                       data, strings, limits, object_hook, array_hook)
     if did_open:
         path_or_file.close()
     return root_object
 
 
-def writePlist(root_object, path_or_file, binary=False):
+def writePlist(root_object, path_or_file, binary=False, compression=None,
+               stream=False, layout=None, hot_keys=None, default=None,
+               plan=None):
     """
     Write root_object to path_or_file. If the named argument binary is set
-    to True, write a binary plist, otherwise write an xml one.
+    to True, write a binary plist, otherwise write an xml one. If compression
+    is one of 'gzip', 'bz2', 'lzma' or 'block', compress the output. If
+    stream is True, write a binary plist as its objects are produced,
+    accepting any iterable, including generators, as an array. If layout is
+    'breadth-first', 'depth-first' or 'hot-keys', place each container's
+    children next to it in a binary plist, in that order; 'hot-keys' puts
+    the entries with keys in hot_keys first. default is called with any
+    object that can't be written, and returns an object to write in its
+    place. plan is a WritePlan for root_object returned by estimate().
     """
     did_open = False
     if isinstance(path_or_file, (str, unicode)):
-        path_or_file = open(path_or_file, "w")
+        path_or_file = open(path_or_file, "wb")
         did_open = True
-    dump(root_object, path_or_file, binary)
+    dump(root_object, path_or_file, binary, compression, stream, layout,
+         hot_keys, default, plan)
     if did_open:
         path_or_file.close()
 
@@ -1,20 +1,49 @@
 # encoding: utf-8
 """This file contains private read/write functions for the bplistlib module."""
 
+from array import array
+from multiprocessing import Pool
+from mmap import mmap, ACCESS_READ
+from os import path
+from tempfile import TemporaryFile
 from .classes import ObjectHandler, TableHandler
-from .classes import TrailerHandler
-from .functions import get_byte_width
+from .classes import TrailerHandler, LimitHandler
+from .functions import get_byte_width, get_reference_size
 
 
-def read(file_object):
+# plists with fewer objects than this are always decoded serially
+PARALLEL_THRESHOLD = 100000
+
+# the read only map of the plist file shared by parallel decoding workers
+shared_map = None
+
+
+def read(file_object, processes=None, **options):
     """
     Read a binary plist from an open file object that supports seeking.
-    Return the root object.
+    Return the root object. If processes is given and the plist is large
+    enough, decode the objects with that many worker processes. If limits
+    is given, it is a dictionary of keyword arguments for a LimitHandler,
+    which is checked while decoding. Any other options are passed on to the
+    ObjectHandler.
     """
     trailer = read_trailer(file_object)
     offset_size, reference_size, length, root, table_offset = trailer
+    limits = options.pop('limits', None)
+    if limits is not None:
+        limit_handler = LimitHandler(**limits)
+        limit_handler.check_trailer(file_object, trailer)
+        options['limit_handler'] = limit_handler
+        processes = None
     offsets = read_table(file_object, offset_size, length, table_offset)
-    root_object = read_objects(file_object, offsets, reference_size, root)
+    if (processes is not None and length >= PARALLEL_THRESHOLD and
+        is_mappable(file_object) and options.get('data') != 'memoryview'):
+        root_object = read_objects_parallel(file_object, offsets,
+                                            reference_size, root, processes,
+                                            **options)
+    else:
+        root_object = read_objects(file_object, offsets, reference_size, root,
+                                   **options)
     return root_object
 
 
@@ -36,45 +65,321 @@ def read_table(file_object, offset_size, length, table_offset):
     return offsets
 
 
-def read_objects(file_object, offsets, reference_size, root):
+def read_objects(file_object, offsets, reference_size, root, **options):
     """Read from an open file_object and return the decoded root object."""
-    object_handler = ObjectHandler()
+    object_handler = ObjectHandler(**options)
     object_handler.set_reference_size(reference_size)
+    limit_handler = object_handler.limit_handler
     objects = []
     for offset in offsets:
         file_object.seek(offset)
         object_ = object_handler.decode(file_object)
         objects.append(object_)
+        if limit_handler is not None:
+            limit_handler.object_sizes.append(file_object.tell() - offset)
     root_object = objects[root]
-    return object_handler.unflatten(root_object, objects)
+    return object_handler.unflatten(root_object, objects, root)
+
+
+def read_objects_parallel(file_object, offsets, reference_size, root,
+                          processes, **options):
+    """
+    Like read_objects, but split the offsets into ranges which are decoded
+    by a pool of worker processes from a shared map of the file.
+    """
+    chunk_count = processes * 4
+    chunk_size = -(-len(offsets) // chunk_count)
+    # the hooks are only needed to unflatten, which the workers don't do
+    worker_options = dict((key, value) for key, value in options.items()
+                          if key not in ('object_hook', 'array_hook'))
+    ranges = [(offsets[start:start + chunk_size], reference_size,
+               worker_options)
+              for start in range(0, len(offsets), chunk_size)]
+    pool = Pool(processes, initialize_worker, (file_object.name,))
+    try:
+        results = pool.map(decode_range, ranges)
+    finally:
+        pool.close()
+        pool.join()
+    objects = []
+    for result in results:
+        objects.extend(result)
+    object_handler = ObjectHandler(**options)
+    object_handler.set_reference_size(reference_size)
+    return object_handler.unflatten(objects[root], objects, root)
+
+
+def is_mappable(file_object):
+    """Return True if file_object is a regular file that can be mapped."""
+    try:
+        file_object.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+    name = getattr(file_object, 'name', None)
+    return isinstance(name, basestring) and path.isfile(name)
+
+
+def initialize_worker(file_name):
+    """Map the plist file into memory in a parallel decoding worker."""
+    global shared_map
+    with open(file_name, 'rb') as file_object:
+        shared_map = mmap(file_object.fileno(), 0, access=ACCESS_READ)
+
 
+def decode_range(arguments):
+    """
+    Decode the objects at the given offsets of the shared map, in a parallel
+    decoding worker. Return the flattened objects.
+    """
+    offsets, reference_size, options = arguments
+    object_handler = ObjectHandler(**options)
+    object_handler.set_reference_size(reference_size)
+    objects = []
+    for offset in offsets:
+        shared_map.seek(offset)
+        objects.append(object_handler.decode(shared_map))
+    return objects
+
+
+def get_references(object_):
+    """
+    Return the references held by a flattened array, or by a flattened
+    dictionary with each key followed by its value.
+    """
+    if type(object_) == list:
+        return object_
+    references = []
+    for key, value in object_.items():
+        references += (key, value)
+    return references
 
-def write(root_object, file_object):
-    """Write the root_object to file_object."""
+
+class ObjectReader(object):
+    """
+    Random access to the objects of a binary plist in an open file object
+    that supports seeking. Only the trailer and the offset table are read up
+    front, objects are decoded when asked for. If lazy is True, not even
+    the offset table is read up front, only the entries that are needed.
+    Any options are passed on to the ObjectHandler.
+    """
+    
+    def __init__(self, file_object, lazy=False, **options):
+        self.file_object = file_object
+        trailer = read_trailer(file_object)
+        offset_size, reference_size, length, root, table_offset = trailer
+        self.trailer = trailer
+        self.root = root
+        if lazy:
+            self.offsets = OffsetTable(file_object, offset_size, length,
+                                       table_offset)
+        else:
+            self.offsets = read_table(file_object, offset_size, length,
+                                      table_offset)
+        self.object_handler = ObjectHandler(**options)
+        self.object_handler.set_reference_size(reference_size)
+    
+    def read_flat(self, reference, offset=None):
+        """
+        Decode and return the object with the given reference number, found
+        at offset if it is known. Containers are returned flattened, holding
+        reference numbers.
+        """
+        if offset is None:
+            offset = self.offsets[reference]
+        self.file_object.seek(offset)
+        return self.object_handler.decode(self.file_object)
+    
+    def read_raw(self, reference):
+        """
+        Return the encoded bytes of the object with the given reference
+        number, including its first byte, without decoding it.
+        """
+        offset = self.offsets[reference]
+        self.file_object.seek(offset)
+        object_type, object_length = self.object_handler.decode_first_byte(
+            self.file_object)
+        handler = self.object_handler.handlers_by_type_number[object_type]
+        byte_length = handler.get_byte_length(object_length)
+        length = self.file_object.tell() - offset + byte_length
+        self.file_object.seek(offset)
+        return self.file_object.read(length)
+    
+    def read_object(self, reference, offset=None):
+        """
+        Decode and return the object with the given reference number, found
+        at offset if it is known. Containers are walked with a stack rather
+        than recursively, and a container that contains itself raises
+        ValueError.
+        """
+        object_ = self.read_flat(reference, offset)
+        if type(object_) not in (list, dict):
+            return object_
+        on_path = set([reference])
+        # each entry is a container, the references of its children and
+        # the children decoded so far
+        stack = [(reference, object_, get_references(object_), [])]
+        while True:
+            reference, object_, references, children = stack[-1]
+            if len(children) < len(references):
+                child = references[len(children)]
+                if child in on_path:
+                    raise ValueError('reference cycle at object %i' % child)
+                child_object = self.read_flat(child)
+                if type(child_object) in (list, dict):
+                    on_path.add(child)
+                    stack.append((child, child_object,
+                                  get_references(child_object), []))
+                else:
+                    children.append(child_object)
+                continue
+            stack.pop()
+            on_path.discard(reference)
+            if type(object_) == list:
+                container = children
+            else:
+                container = dict(zip(children[::2], children[1::2]))
+            container = self.object_handler.apply_hook(container)
+            if not stack:
+                return container
+            stack[-1][3].append(container)
+    
+    def find(self, key_path, reference=None):
+        """
+        Return the reference number of the object found by following
+        key_path, a sequence of dictionary keys and array indices, from the
+        object with the given reference number, or the root object. Raise
+        KeyError if there is no such object.
+        """
+        if reference is None:
+            reference = self.root
+        for key in key_path:
+            container = self.read_flat(reference)
+            if type(container) == list and isinstance(key, (int, long)):
+                try:
+                    reference = container[key]
+                except IndexError:
+                    raise KeyError(key)
+            elif type(container) == dict:
+                for key_reference, value_reference in container.items():
+                    if self.read_flat(key_reference) == key:
+                        reference = value_reference
+                        break
+                else:
+                    raise KeyError(key)
+            else:
+                raise KeyError(key)
+        return reference
+    
+
+class OffsetTable(object):
+    """
+    The offset table of a binary plist in an open file object, read an
+    entry at a time as the entries are asked for.
+    """
+    
+    def __init__(self, file_object, offset_size, length, table_offset):
+        self.file_object = file_object
+        self.offset_size = offset_size
+        self.length = length
+        self.table_offset = table_offset
+    
+    def __len__(self):
+        return self.length
+    
+    def __getitem__(self, reference):
+        if not 0 <= reference < self.length:
+            raise IndexError(reference)
+        self.file_object.seek(self.table_offset + reference * self.offset_size)
+        offset = 0
+        for byte in self.file_object.read(self.offset_size):
+            offset = offset << 8 | ord(byte)
+        return offset
+    
+
+def write(root_object, file_object, layout=None, hot_keys=None, default=None,
+          plan=None):
+    """
+    Write the root_object to file_object. If layout is given, reorder the
+    objects with ObjectHandler.order_objects. default is passed on to the
+    ObjectHandler. If plan is a WritePlan made for root_object, its objects
+    are written without collecting them again.
+    """
     file_object.write('bplist00')
-    offsets = write_objects(file_object, root_object)
+    offsets = write_objects(file_object, root_object, layout, hot_keys,
+                            default, plan)
     table_offset = write_table(file_object, offsets)
     write_trailer(file_object, offsets, table_offset)
 
 
-def write_objects(file_object, root_object):
+def write_objects(file_object, root_object, layout=None, hot_keys=None,
+                  default=None, plan=None):
     """
     Flatten all objects, encode, and write the encoded objects to file_object.
     """
-    objects = []
-    object_handler = ObjectHandler()
-    object_handler.collect_objects(root_object, objects)
-    object_handler.flatten_objects(objects)
-    reference_size = get_byte_width(len(objects), 2)
-    object_handler.set_reference_size(reference_size)
+    if plan is None:
+        plan = make_plan(root_object, layout, hot_keys, default)
+    elif plan.root_object is not root_object:
+        raise ValueError('the plan was made for a different object')
+    object_handler = plan.object_handler
     offsets = []
-    for object_ in objects:
+    for object_ in plan.objects:
         offsets.append(file_object.tell())
         encoded_object = object_handler.encode(object_)
         file_object.write(encoded_object)
     return offsets
 
 
+def make_plan(root_object, layout=None, hot_keys=None, default=None):
+    """
+    Collect, order and flatten the objects in root_object, and return them
+    in a WritePlan.
+    """
+    objects = []
+    object_handler = ObjectHandler(default=default)
+    object_handler.collect_objects(root_object, objects)
+    if layout is not None:
+        objects = object_handler.order_objects(objects, layout, hot_keys)
+    object_handler.flatten_objects(objects)
+    reference_size = get_reference_size(len(objects))
+    object_handler.set_reference_size(reference_size)
+    return WritePlan(root_object, objects, object_handler, reference_size)
+
+
+class WritePlan(object):
+    """
+    The collected and flattened objects of root_object, ready to be
+    encoded, and the sizes of the binary plist they make once measured.
+    The plan is only valid while root_object is unchanged.
+    """
+    
+    def __init__(self, root_object, objects, object_handler, reference_size):
+        self.root_object = root_object
+        self.objects = objects
+        self.object_handler = object_handler
+        self.object_count = len(objects)
+        self.reference_size = reference_size
+        self.offset_size = None
+        self.size = None
+        self.fits = None
+    
+    def measure(self):
+        """
+        Work out the exact size in bytes of the binary plist, the size of
+        its offsets, and whether the offsets and the number of objects fit
+        the widths this module writes, without encoding any objects.
+        """
+        object_handler = self.object_handler
+        table_offset = 8
+        for object_ in self.objects:
+            table_offset += object_handler.get_encoded_length(object_)
+        offset_size = get_byte_width(table_offset, 8)
+        if offset_size > 4:
+            offset_size = 8
+        self.offset_size = offset_size
+        self.size = table_offset + offset_size * self.object_count + 32
+        self.fits = offset_size <= 4 and self.object_count < 0x100000000
+    
+
 def write_table(file_object, offsets):
     """Encode the offsets and write to file_object."""
     table_handler = TableHandler()
@@ -84,8 +389,148 @@ def write_table(file_object, offsets):
     return table_offset
 
 
-def write_trailer(file_object, offsets, table_offset):
+def write_trailer(file_object, offsets, table_offset, root=0):
     """Encode the trailer section and write to file_object."""
     trailer_handler = TrailerHandler()
-    trailer = trailer_handler.encode(offsets, table_offset)
+    trailer = trailer_handler.encode(offsets, table_offset, root)
     file_object.write(trailer)
+
+
+def write_stream(root_object, file_object, default=None):
+    """
+    Write the root_object to file_object with a StreamWriter, so that arrays
+    may be given as any iterable, including generators.
+    """
+    stream_writer = StreamWriter(file_object, default=default)
+    stream_writer.add(root_object)
+    stream_writer.close()
+
+
+class StreamWriter(object):
+    """
+    Write a binary plist to an open file object as its objects are produced.
+    
+    Leaf objects are encoded and written immediately. The reference lists of
+    open containers are kept in compact arrays, and spilled to a temporary
+    file when the container ends. Once the number of objects, and so the
+    reference size, is known, the containers are written after the leaves,
+    followed by the offset table and the trailer. Apart from the offset
+    table, memory use depends on the nesting depth, not on the amount of
+    data. Objects are not deduplicated, except for dictionary keys.
+    """
+    
+    def __init__(self, file_object, key_cache_size=1024, default=None):
+        self.file_object = file_object
+        self.object_handler = ObjectHandler(default=default)
+        self.offsets = array('L')
+        self.containers = array('L')
+        self.container_types = array('B')
+        self.container_lengths = array('L')
+        self.spill_file = TemporaryFile()
+        self.stack = []
+        self.root = None
+        self.key_references = {}
+        self.key_cache_size = key_cache_size
+        file_object.write('bplist00')
+    
+    def add(self, object_):
+        """
+        Add object_ to the innermost open container, or make it the root
+        object. Dictionaries and iterables are added recursively, with
+        iterables of no other supported type written as arrays.
+        """
+        object_handler = self.object_handler
+        base_type = object_handler.get_base_type(type(object_))
+        if base_type is None and hasattr(object_, '__iter__'):
+            base_type = list
+        else:
+            # nothing is remembered, so memory doesn't grow with the data
+            object_ = object_handler.apply_default(object_)
+            base_type = object_handler.get_base_type(type(object_))
+        if base_type == dict:
+            self.start_dictionary()
+            for key, value in object_.iteritems():
+                self.add_key(key)
+                self.add(value)
+            self.end()
+        elif base_type in (list, tuple):
+            self.start_array()
+            for item in object_:
+                self.add(item)
+            self.end()
+        else:
+            self.add_reference(self.write_leaf(object_))
+    
+    def add_key(self, key):
+        """Add a dictionary key, reusing the object for keys seen before."""
+        cache_key = (type(key), key)
+        reference = self.key_references.get(cache_key)
+        if reference is None:
+            reference = self.write_leaf(key)
+            if len(self.key_references) < self.key_cache_size:
+                self.key_references[cache_key] = reference
+        self.add_reference(reference)
+    
+    def start_array(self):
+        """Open an array. Following objects are added to it until end()."""
+        self.stack.append((0xa, array('L')))
+    
+    def start_dictionary(self):
+        """
+        Open a dictionary. Following objects are added to it, alternating
+        between keys and values, until end().
+        """
+        self.stack.append((0xd, array('L')))
+    
+    def end(self):
+        """Close the innermost open container."""
+        type_number, references = self.stack.pop()
+        if type_number == 0xd:
+            references = references[0::2] + references[1::2]
+        reference = len(self.offsets)
+        self.offsets.append(0)
+        self.containers.append(reference)
+        self.container_types.append(type_number)
+        self.container_lengths.append(len(references))
+        references.tofile(self.spill_file)
+        self.add_reference(reference)
+    
+    def write_leaf(self, object_):
+        """Encode and write a leaf object, and return its reference."""
+        reference = len(self.offsets)
+        self.offsets.append(self.file_object.tell())
+        self.file_object.write(self.object_handler.encode(object_))
+        return reference
+    
+    def add_reference(self, reference):
+        """Add a reference to the innermost open container, or the root."""
+        if self.stack:
+            self.stack[-1][1].append(reference)
+        else:
+            self.root = reference
+    
+    def close(self):
+        """
+        Write the containers, the offset table and the trailer. The file
+        object is left open.
+        """
+        if self.stack or self.root is None:
+            raise ValueError('unbalanced stream of objects')
+        object_handler = self.object_handler
+        object_handler.set_reference_size(get_reference_size(len(self.offsets)))
+        array_handler = object_handler.handlers_by_type[list]
+        self.spill_file.seek(0)
+        for index, reference in enumerate(self.containers):
+            type_number = self.container_types[index]
+            references = array('L')
+            references.fromfile(self.spill_file, self.container_lengths[index])
+            length = len(references)
+            if type_number == 0xd:
+                length = length // 2
+            self.offsets[reference] = self.file_object.tell()
+            first_byte = object_handler.encode_first_byte(type_number, length)
+            body = array_handler.encode_body(references, len(references))
+            self.file_object.write(first_byte + body)
+        self.spill_file.close()
+        table_offset = write_table(self.file_object, self.offsets)
+        write_trailer(self.file_object, self.offsets, table_offset, self.root)
@@ -3,6 +3,9 @@ Some classes that can be encoded in a binary plist but don't map into
 python's type hierarchy.
 """
 
+from datetime import timedelta, tzinfo
+
+
 class UID(int):
     """A class for integer UID values."""
     def __init__(self, value):
@@ -17,6 +20,33 @@ class FillType(object):
     def __repr__(self):
         return 'Fill'
     
+    def __reduce__(self):
+        """Unpickle as the Fill singleton."""
+        return 'Fill'
+    
+
+
+Fill = FillType()
+
+
+class UTCType(tzinfo):
+    """A tzinfo class for UTC, for timezone aware dates."""
+    def utcoffset(self, date):
+        return timedelta(0)
+    
+    def dst(self, date):
+        return timedelta(0)
+    
+    def tzname(self, date):
+        return 'UTC'
+    
+    def __repr__(self):
+        return 'UTC'
+    
+    def __reduce__(self):
+        """Unpickle as the UTC singleton."""
+        return 'UTC'
+    
 
 
-Fill = FillType()
\ No newline at end of file
+UTC = UTCType()
\ No newline at end of file
@@ -0,0 +1,204 @@
+# encoding: utf-8
+"""
+This file contains the structural validation of binary plists for the
+bplistlib module.
+
+validate() checks a binary plist in a single pass over the trailer, the
+offset table and the first bytes of every object, without decoding any
+values. Every offset, length and reference is bounds checked, and the
+objects reachable from the root are checked for reference cycles.
+"""
+
+from mmap import mmap, ACCESS_READ
+from struct import unpack_from, calcsize
+from .classes import ObjectHandler
+from .compression import open_compressed
+
+
+TRAILER_FORMAT = '>6xBBQQQ'
+TRAILER_SIZE = calcsize(TRAILER_FORMAT)
+INTEGER_FORMATS = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+TYPE_NAMES = {0: 'boolean', 1: 'integer', 2: 'real', 3: 'date', 4: 'data',
+              5: 'string', 6: 'unicode', 8: 'uid', 0xa: 'array', 0xd: 'dict'}
+# the object lengths each type of object may have, if restricted
+OBJECT_LENGTHS = {0: (0, 8, 9, 15), 1: (0, 1, 2, 3), 2: (2, 3), 3: (3,),
+                  8: (0, 1, 2, 3)}
+
+
+class InvalidPlistError(ValueError):
+    """Raised when a binary plist is not structurally valid."""
+
+
+def validate(fp_or_string):
+    """
+    Check the structure of the binary plist in fp_or_string, which is
+    either a string or an open file object. Return a dictionary of
+    statistics: the number of objects, the number of each type of object,
+    the offset and reference sizes, the greatest depth of nesting, and the
+    number of objects reachable from the root. Raise InvalidPlistError if
+    the plist is not valid.
+    """
+    return call_with_buffer(validate_buffer, fp_or_string)
+
+
+def call_with_buffer(function, fp_or_string):
+    """
+    Call function with the plist in fp_or_string, a string or an open file
+    object, as a string or a read only memory map, and return the result.
+    Compressed files are decompressed first.
+    """
+    if isinstance(fp_or_string, basestring):
+        return function(fp_or_string)
+    file_object = open_compressed(fp_or_string)
+    try:
+        file_object.seek(0)
+        buffer_ = mmap(file_object.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        file_object.seek(0)
+        return function(file_object.read())
+    try:
+        return function(buffer_)
+    finally:
+        buffer_.close()
+
+
+def validate_buffer(buffer_):
+    """Validate the binary plist in a string or memory map."""
+    trailer = check_trailer(buffer_)
+    offset_size, reference_size, length, root, table_offset = trailer
+    offsets = read_offsets(buffer_, offset_size, length, table_offset)
+    object_handler = ObjectHandler()
+    object_handler.set_reference_size(reference_size)
+    types = {}
+    containers = {}
+    for reference, offset in enumerate(offsets):
+        object_type, body_offset, byte_length = read_header(
+            buffer_, offset, table_offset, object_handler)
+        name = TYPE_NAMES[object_type]
+        types[name] = types.get(name, 0) + 1
+        if object_type in (0xa, 0xd):
+            containers[reference] = (body_offset, byte_length)
+    reachable, max_depth = check_references(buffer_, root, length,
+                                            reference_size, containers)
+    return {'objects': length, 'types': types, 'offset_size': offset_size,
+            'reference_size': reference_size, 'max_depth': max_depth,
+            'reachable': reachable}
+
+
+def check_trailer(buffer_):
+    """
+    Check the header and the trailer of the binary plist in a string or
+    memory map, and return the decoded trailer.
+    """
+    size = len(buffer_)
+    if size < 8 + TRAILER_SIZE or buffer_[:7] != 'bplist0':
+        raise InvalidPlistError('not a binary plist')
+    trailer = unpack_from(TRAILER_FORMAT, buffer_, size - TRAILER_SIZE)
+    offset_size, reference_size, length, root, table_offset = trailer
+    if offset_size not in (1, 2, 3, 4, 8):
+        raise InvalidPlistError('invalid offset size: %i' % offset_size)
+    if reference_size not in INTEGER_FORMATS:
+        raise InvalidPlistError('invalid reference size: %i' % reference_size)
+    if length == 0 or root >= length:
+        raise InvalidPlistError('invalid root object: %i' % root)
+    if (table_offset < 9 or
+        table_offset + length * offset_size > size - TRAILER_SIZE):
+        raise InvalidPlistError('offset table out of bounds')
+    return trailer
+
+
+def read_offsets(buffer_, offset_size, length, table_offset):
+    """Read the offset table without going through a file object."""
+    if offset_size != 3:
+        format_ = '>%i%s' % (length, INTEGER_FORMATS[offset_size])
+        return unpack_from(format_, buffer_, table_offset)
+    raw = unpack_from('>%iB' % (length * 3), buffer_, table_offset)
+    return [raw[i] << 16 | raw[i + 1] << 8 | raw[i + 2]
+            for i in range(0, len(raw), 3)]
+
+
+def read_header(buffer_, offset, table_offset, object_handler):
+    """
+    Check the header of the object at offset, like decode_first_byte, and
+    return its type, the offset of its body and the byte length of its
+    body.
+    """
+    if not 8 <= offset < table_offset:
+        raise InvalidPlistError('object offset out of bounds: %i' % offset)
+    value = ord(buffer_[offset])
+    object_type = value >> 4
+    object_length = value & 0xF
+    if object_type not in TYPE_NAMES:
+        raise InvalidPlistError('unsupported object type %#x at offset %i' %
+                                (object_type, offset))
+    body_offset = offset + 1
+    if object_length == 15 and object_type != 0:
+        if body_offset >= table_offset:
+            raise InvalidPlistError('object length out of bounds')
+        size_value = ord(buffer_[body_offset])
+        width = 1 << (size_value & 0xF)
+        if size_value >> 4 != 1 or width not in INTEGER_FORMATS:
+            raise InvalidPlistError('invalid object length at offset %i' %
+                                    offset)
+        if body_offset + 1 + width > table_offset:
+            raise InvalidPlistError('object length out of bounds')
+        object_length = unpack_from('>' + INTEGER_FORMATS[width], buffer_,
+                                    body_offset + 1)[0]
+        body_offset += 1 + width
+    allowed = OBJECT_LENGTHS.get(object_type)
+    if allowed is not None and object_length not in allowed:
+        raise InvalidPlistError('invalid object length at offset %i' % offset)
+    handler = object_handler.handlers_by_type_number[object_type]
+    byte_length = handler.get_byte_length(object_length)
+    if body_offset + byte_length > table_offset:
+        raise InvalidPlistError('object at offset %i declares %i bytes, '
+                                'past the end of the object data' %
+                                (offset, byte_length))
+    return object_type, body_offset, byte_length
+
+
+def check_references(buffer_, root, length, reference_size, containers):
+    """
+    Walk the containers reachable from the root, checking that every
+    reference is in bounds and that there are no cycles. Return the number
+    of reachable objects and the greatest depth of nesting.
+    """
+    reference_format = INTEGER_FORMATS[reference_size]
+    # 0 for unvisited, 1 for on the current path, 2 for done
+    states = bytearray(length)
+    states[root] = 1
+    reachable = 1
+    max_depth = 0
+    stack = [(root, iter(read_references(buffer_, root, containers,
+                                         reference_size, reference_format)))]
+    while stack:
+        reference, children = stack[-1]
+        max_depth = max(max_depth, len(stack) - 1)
+        for child in children:
+            if child >= length:
+                raise InvalidPlistError('reference out of bounds: %i' % child)
+            if states[child] == 1:
+                raise InvalidPlistError('reference cycle at object %i' % child)
+            if states[child] == 0:
+                reachable += 1
+                states[child] = 1
+                grandchildren = read_references(buffer_, child, containers,
+                                                reference_size,
+                                                reference_format)
+                stack.append((child, iter(grandchildren)))
+                break
+        else:
+            states[reference] = 2
+            stack.pop()
+    return reachable, max_depth
+
+
+def read_references(buffer_, reference, containers, reference_size,
+                    reference_format):
+    """Return the references held by an object, if it is a container."""
+    if reference not in containers:
+        return ()
+    body_offset, byte_length = containers[reference]
+    count = byte_length // reference_size
+    return unpack_from('>%i%s' % (count, reference_format), buffer_,
+                       body_offset)
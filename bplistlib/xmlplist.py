@@ -0,0 +1,456 @@
+# encoding: utf-8
+"""
+This file contains the streaming XML plist reader and writer for the
+bplistlib module.
+
+Both sides work through the same small event interface as the StreamWriter
+for binary plists: start_array(), start_dictionary(), add_key(key),
+add(value) and end(). The XMLParser produces these events from an expat
+parser, and the XMLWriter writes them out as they arrive, so a plist can be
+converted between formats without building the whole tree in memory.
+
+UID objects are stored in XML as a dictionary with the single key 'CF$UID'.
+XML plists have no representation for None or Fill.
+"""
+
+from base64 import b64decode, b64encode
+from datetime import datetime
+from plistlib import Data
+import re
+from xml.parsers.expat import ParserCreate
+from .functions import is_ascii
+from .readwrite import ObjectReader, StreamWriter
+from .types import UID, FillType, UTC
+
+
+XML_HEADER = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" \
+"http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+'''
+XML_FOOTER = '</plist>\n'
+UID_KEY = 'CF$UID'
+DATE_PATTERN = re.compile(r'(?P<year>\d\d\d\d)(?:-(?P<month>\d\d)'
+                          r'(?:-(?P<day>\d\d)(?:T(?P<hour>\d\d)'
+                          r'(?::(?P<minute>\d\d)(?::(?P<second>\d\d))?)?)?)?)?Z')
+DATE_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+# the reference date of plist dates
+EPOCH = datetime(2001, 1, 1)
+
+
+def read_xml(file_object, dates='datetime', data='Data', strings='str',
+             object_hook=None, array_hook=None, limit_handler=None):
+    """
+    Read an XML plist from file_object and return the root object. Dates
+    are decoded according to dates: 'datetime' for naive datetime objects
+    in UTC, as plistlib does, 'utc' for timezone aware datetime objects, or
+    'seconds' for the number of seconds since 1 Jan 2001. The data,
+    strings, object_hook and array_hook arguments have the same meaning as
+    for binary plists. If a LimitHandler is given, parsing is checked
+    against it.
+    """
+    tree_builder = TreeBuilder(object_hook, array_hook)
+    parser = XMLParser(tree_builder, dates, data, strings, limit_handler)
+    parser.parse(file_object)
+    return tree_builder.root
+
+
+def write_xml(root_object, file_object, default=None):
+    """
+    Write root_object to file_object as an XML plist. default is called
+    with any object that can't be written, and returns an object to write
+    in its place.
+    """
+    xml_writer = XMLWriter(file_object, default)
+    xml_writer.add(root_object)
+    xml_writer.close()
+
+
+def convert_to_binary(input_file, output_file):
+    """
+    Convert the XML plist in input_file to a binary plist in output_file,
+    streaming the objects from the XML parser to a StreamWriter.
+    """
+    stream_writer = StreamWriter(output_file)
+    parser = XMLParser(stream_writer, dates='utc')
+    parser.parse(input_file)
+    stream_writer.close()
+
+
+def convert_to_xml(input_file, output_file):
+    """
+    Convert the binary plist in input_file to an XML plist in output_file,
+    decoding one object at a time.
+    """
+    reader = ObjectReader(input_file, dates='utc')
+    xml_writer = XMLWriter(output_file)
+    write_reference(reader, reader.root, xml_writer)
+    xml_writer.close()
+
+
+def write_reference(reader, reference, xml_writer):
+    """
+    Write the object with the given reference from reader as XML. Containers
+    are walked with a stack rather than recursively, and a container that
+    contains itself raises ValueError.
+    """
+    on_path = set()
+    # each entry is an open container, whether it is a dictionary, and an
+    # iterator over its children, with their keys for a dictionary
+    stack = [(None, False, iter([reference]))]
+    while stack:
+        container, is_dictionary, children = stack[-1]
+        for child in children:
+            if is_dictionary:
+                key, child = child
+                xml_writer.add_key(key)
+            object_ = reader.read_flat(child)
+            if type(object_) not in (list, dict):
+                xml_writer.add(object_)
+                continue
+            if child in on_path:
+                raise ValueError('reference cycle at object %i' % child)
+            on_path.add(child)
+            if type(object_) == list:
+                xml_writer.start_array()
+                stack.append((child, False, iter(object_)))
+            else:
+                xml_writer.start_dictionary()
+                items = [(reader.read_flat(key), value)
+                         for key, value in object_.iteritems()]
+                stack.append((child, True, iter(sorted(items))))
+            break
+        else:
+            stack.pop()
+            if container is not None:
+                xml_writer.end()
+                on_path.discard(container)
+
+
+class TreeBuilder(object):
+    """
+    Build python objects from plist events. object_hook and array_hook are
+    called with each dictionary and array once it ends, and their results
+    are used in place of the container.
+    """
+
+    def __init__(self, object_hook=None, array_hook=None):
+        self.stack = []
+        self.root = None
+        self.object_hook = object_hook
+        self.array_hook = array_hook
+
+    def start_array(self):
+        """Open an array."""
+        self.stack.append([[], None])
+
+    def start_dictionary(self):
+        """Open a dictionary."""
+        self.stack.append([{}, None])
+
+    def add_key(self, key):
+        """Set the key for the next value added to the open dictionary."""
+        self.stack[-1][1] = key
+
+    def add(self, value):
+        """Add value to the innermost open container, or make it the root."""
+        if not self.stack:
+            self.root = value
+            return
+        container, key = self.stack[-1]
+        if type(container) == list:
+            container.append(value)
+        else:
+            container[key] = value
+
+    def end(self):
+        """Close the innermost open container."""
+        container = self.stack.pop()[0]
+        if type(container) == dict:
+            if self.object_hook is not None:
+                container = self.object_hook(container)
+        elif self.array_hook is not None:
+            container = self.array_hook(container)
+        self.add(container)
+
+
+class XMLParser(object):
+    """
+    Parse an XML plist with expat, and pass the objects found to a sink
+    with the plist event interface. With a LimitHandler, the bytes read,
+    the objects found, the size of their text and the depth of containers
+    are checked against its limits.
+    """
+
+    def __init__(self, sink, dates='datetime', data='Data', strings='str',
+                 limit_handler=None):
+        if dates not in ('datetime', 'utc', 'seconds'):
+            raise ValueError('unknown date format: %r' % dates)
+        if data not in ('Data', 'bytes', 'memoryview'):
+            raise ValueError('unknown data format: %r' % data)
+        if strings not in ('str', 'unicode'):
+            raise ValueError('unknown string format: %r' % strings)
+        self.sink = sink
+        self.dates = dates
+        self.data = data
+        self.strings = strings
+        self.text = []
+        self.text_length = 0
+        self.limit_handler = limit_handler
+        self.depth = 0
+        # a dictionary that might still turn out to be a UID
+        self.pending = None
+
+    def parse(self, file_object):
+        """Parse the XML plist in file_object."""
+        parser = ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.handle_begin_element
+        parser.EndElementHandler = self.handle_end_element
+        parser.CharacterDataHandler = self.handle_data
+        parser.EntityDeclHandler = self.handle_entity_declaration
+        if self.limit_handler is None:
+            parser.ParseFile(file_object)
+            return
+        while True:
+            chunk = file_object.read(0x10000)
+            self.limit_handler.check_read(len(chunk))
+            if not chunk:
+                break
+            parser.Parse(chunk)
+        parser.Parse('', True)
+
+    def handle_begin_element(self, element, attributes):
+        """Reset the collected text, and open containers."""
+        self.text = []
+        self.text_length = 0
+        if self.limit_handler is not None and element in ('dict', 'array'):
+            self.depth += 1
+            self.limit_handler.check_depth(self.depth)
+        if element == 'dict':
+            self.flush()
+            self.pending = [element]
+        elif element == 'array':
+            self.flush()
+            self.sink.start_array()
+
+    def handle_end_element(self, element):
+        """Decode the element that ends, and pass it on to the sink."""
+        text = ''.join(self.text)
+        # the whitespace after a closing tag belongs to no element
+        self.text = []
+        self.text_length = 0
+        if self.limit_handler is not None and element != 'plist':
+            self.limit_handler.check_built()
+            if element in ('dict', 'array'):
+                self.depth -= 1
+        if element in ('dict', 'array'):
+            if self.pending is not None and len(self.pending) == 3:
+                uid = UID(self.pending[2])
+                self.pending = None
+                self.sink.add(uid)
+            else:
+                self.flush()
+                self.sink.end()
+        elif element == 'key':
+            key = self.convert_string(text)
+            if self.pending == ['dict'] and key == UID_KEY:
+                self.pending.append(key)
+            else:
+                self.flush()
+                self.sink.add_key(key)
+        elif element != 'plist':
+            value = self.convert(element, text)
+            if (self.pending is not None and len(self.pending) == 2 and
+                element == 'integer'):
+                self.pending.append(value)
+            else:
+                self.flush()
+                self.sink.add(value)
+
+    def handle_data(self, data):
+        """Collect the text of the current element."""
+        self.text.append(data)
+        if self.limit_handler is not None:
+            self.text_length += len(data)
+            self.limit_handler.check_size(self.text_length)
+            self.limit_handler.check_built_bytes(len(data))
+
+    def handle_entity_declaration(self, name, *arguments):
+        """
+        Refuse entity declarations, which could expand a small plist into
+        an enormous one.
+        """
+        raise ValueError('entity declarations are not supported: %s' % name)
+
+    def flush(self):
+        """Pass on a pending dictionary, once it is known not to be a UID."""
+        if self.pending is None:
+            return
+        pending = self.pending
+        self.pending = None
+        self.sink.start_dictionary()
+        if len(pending) > 1:
+            self.sink.add_key(pending[1])
+        if len(pending) > 2:
+            self.sink.add(pending[2])
+
+    def convert(self, element, text):
+        """Convert the text of a leaf element to a python object."""
+        if element == 'string':
+            return self.convert_string(text)
+        if element == 'integer':
+            return int(text)
+        if element == 'real':
+            return float(text)
+        if element == 'true':
+            return True
+        if element == 'false':
+            return False
+        if element == 'date':
+            return self.convert_date(text)
+        if element == 'data':
+            raw = b64decode(text.encode('ascii'))
+            if self.data == 'bytes':
+                return raw
+            if self.data == 'memoryview':
+                return memoryview(raw)
+            return Data(raw)
+        raise ValueError('unknown plist element: %r' % element)
+
+    def convert_string(self, text):
+        """Return text as str if it is ASCII, unless configured otherwise."""
+        if self.strings == 'str' and is_ascii(text):
+            return text.encode('ascii')
+        return text
+
+    def convert_date(self, text):
+        """Convert an ISO 8601 date in UTC as configured."""
+        match = DATE_PATTERN.match(text)
+        if match is None:
+            raise ValueError('invalid date: %r' % text)
+        fields = [int(match.group(field) or 1) for field in DATE_FIELDS[:3]]
+        fields += [int(match.group(field) or 0) for field in DATE_FIELDS[3:]]
+        date = datetime(*fields)
+        if self.dates == 'seconds':
+            return (date - EPOCH).total_seconds()
+        if self.dates == 'utc':
+            return date.replace(tzinfo=UTC)
+        return date
+
+
+class XMLWriter(object):
+    """Write an XML plist to an open file object as events arrive."""
+
+    def __init__(self, file_object, default=None):
+        self.file_object = file_object
+        self.stack = []
+        self.default = default
+        file_object.write(XML_HEADER)
+
+    def add(self, object_):
+        """
+        Write object_. Dictionaries, with their keys sorted, and lists are
+        written recursively.
+        """
+        if isinstance(object_, dict):
+            self.start_dictionary()
+            for key, value in sorted(object_.iteritems()):
+                self.add_key(key)
+                self.add(value)
+            self.end()
+        elif isinstance(object_, (list, tuple)):
+            self.start_array()
+            for item in object_:
+                self.add(item)
+            self.end()
+        elif isinstance(object_, UID):
+            self.start_dictionary()
+            self.add_key(UID_KEY)
+            self.write_element('integer', '%i' % object_)
+            self.end()
+        else:
+            self.write_leaf(object_)
+
+    def start_array(self):
+        """Open an array."""
+        self.write_line('<array>')
+        self.stack.append('array')
+
+    def start_dictionary(self):
+        """Open a dictionary."""
+        self.write_line('<dict>')
+        self.stack.append('dict')
+
+    def add_key(self, key):
+        """Write the key for the next value of the open dictionary."""
+        if not isinstance(key, basestring):
+            raise TypeError('dictionary keys must be strings: %r' % (key,))
+        self.write_element('key', escape(key))
+
+    def end(self):
+        """Close the innermost open container."""
+        self.write_line('</%s>' % self.stack.pop())
+
+    def close(self):
+        """Finish the plist. The file object is left open."""
+        if self.stack:
+            raise ValueError('unbalanced stream of objects')
+        self.file_object.write(XML_FOOTER)
+
+    def write_leaf(self, object_):
+        """Write a leaf object."""
+        if isinstance(object_, bool):
+            self.write_line(object_ and '<true/>' or '<false/>')
+        elif isinstance(object_, (int, long)):
+            self.write_element('integer', '%i' % object_)
+        elif isinstance(object_, float):
+            self.write_element('real', repr(object_))
+        elif isinstance(object_, basestring):
+            self.write_element('string', escape(object_))
+        elif isinstance(object_, datetime):
+            if object_.utcoffset() is not None:
+                object_ = object_.astimezone(UTC).replace(tzinfo=None)
+            fields = object_.timetuple()[:6]
+            self.write_element('date', '%04i-%02i-%02iT%02i:%02i:%02iZ' % fields)
+        elif isinstance(object_, (Data, bytearray, memoryview, buffer)):
+            self.write_data(object_)
+        elif object_ is None or isinstance(object_, FillType):
+            raise TypeError('%r can not be stored in an XML plist' % object_)
+        elif self.default is not None:
+            self.add(self.default(object_))
+        else:
+            raise TypeError('unsupported type: %s' % type(object_))
+
+    def write_data(self, data):
+        """Write binary data base64 encoded, in lines like plistlib."""
+        if isinstance(data, Data):
+            raw = data.data
+        elif isinstance(data, memoryview):
+            raw = data.tobytes()
+        else:
+            raw = str(data)
+        indent = '\t' * len(self.stack)
+        line_length = max(16, 76 - len(indent.expandtabs(8))) // 4 * 3
+        self.write_line('<data>')
+        for start in range(0, len(raw), line_length):
+            self.write_line(b64encode(raw[start:start + line_length]))
+        self.write_line('</data>')
+
+    def write_element(self, element, text):
+        """Write an element holding text on its own line."""
+        self.write_line('<%s>%s</%s>' % (element, text, element))
+
+    def write_line(self, line):
+        """Write line, indented to the current depth."""
+        self.file_object.write('\t' * len(self.stack) + line + '\n')
+
+
+def escape(text):
+    """Return text escaped for XML, encoded as UTF-8."""
+    if isinstance(text, unicode):
+        text = text.encode('utf_8')
+    text = text.replace('&', '&amp;')
+    text = text.replace('<', '&lt;')
+    return text.replace('>', '&gt;')
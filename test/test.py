@@ -6,11 +6,20 @@
 # may be missed.
 
 from datetime import datetime
+from collections import OrderedDict
+from cStringIO import StringIO
 from plistlib import Data
-from os import remove
+from os import remove, utime
+from struct import pack
+import plistlib
 import unittest
 import random
+import sys
 import bplistlib as bp
+import bplistlib.classes
+import bplistlib.compression
+import bplistlib.readwrite
+import bplistlib.__main__
 
 
 class Tests(unittest.TestCase):
@@ -82,6 +91,32 @@ class Tests(unittest.TestCase):
         self.assertEqual(value.hour, result.hour)
         self.assertEqual(value.minute, result.minute)
     
+    def test_date_microseconds(self):
+        value = datetime(2010, 6, 1, 12, 30, 15, 250000)
+        result = through_string(value)
+        self.assertEqual(value, result)
+    
+    def test_date_utc(self):
+        value = datetime(2010, 6, 1, 12, 30, 15, 250000, tzinfo=bp.UTC)
+        plist = bp.dumps(value, binary=True)
+        result = bp.loads(plist, dates='utc')
+        self.assertEqual(value, result)
+        self.assertEqual(result.tzinfo, bp.UTC)
+        result = bp.loads(plist, dates='seconds')
+        self.assertIsInstance(result, float)
+        self.assertAlmostEqual(result, 297088215.25, places=3)
+    
+    def test_data_formats(self):
+        raw = '\xe0\x54\x6e\xb3\x2e\x7f'
+        for value in (bytearray(raw), memoryview(raw), buffer(raw)):
+            plist = bp.dumps(value, binary=True)
+            result = bp.loads(plist, data='bytes')
+            self.assertIsInstance(result, str)
+            self.assertEqual(result, raw)
+            result = bp.loads(plist, data='memoryview')
+            self.assertIsInstance(result, memoryview)
+            self.assertEqual(result.tobytes(), raw)
+    
     def test_data(self):
         value = Data('\xe0\x54\x6e\xb3\x2e\x7f\xe2\x0c\xd4\xad\x05\x49\xfc')
         result = through_string(value)
@@ -95,11 +130,28 @@ class Tests(unittest.TestCase):
         self.assertEqual(value, result)
     
     def test_unicode(self):
-        value = u'world'
+        value = u'w\xf6rld'
         result = through_string(value)
         self.assertIsInstance(result, type(value))
         self.assertEqual(value, result)
     
+    def test_ascii_unicode(self):
+        value = u'world'
+        plist = bp.dumps(value, binary=True)
+        self.assertIn('\x55world', plist)
+        result = bp.loads(plist)
+        self.assertIsInstance(result, str)
+        self.assertEqual(value, result)
+        result = bp.loads(plist, strings='unicode')
+        self.assertIsInstance(result, unicode)
+        self.assertEqual(value, result)
+    
+    def test_non_ascii_string(self):
+        value = u'\U0001f600 w\xf6rld'
+        result = through_string(value.encode('utf_8'))
+        self.assertIsInstance(result, unicode)
+        self.assertEqual(value, result)
+    
     def test_array(self):
         value = [1, 2, 3, 4]
         result = through_string(value)
@@ -167,12 +219,517 @@ class Tests(unittest.TestCase):
         self.assertEqual(value, result)
         remove('tmp')
     
+    def test_xml(self):
+        value = {'a': [1, 2.5, True, u'w\xf6rld <&>'], 'b': bp.UID(7),
+                 'c': Data('\x00\x01' * 100), 'd': datetime(2010, 6, 1, 12),
+                 'e': {}, 'f': {'CF$UID': 'x'}}
+        plist = bp.dumps(value)
+        self.assertEqual(plistlib.readPlistFromString(plist)['b'],
+                         {'CF$UID': 7})
+        result = bp.loads(plist)
+        self.assertEqual(result['c'].data, value['c'].data)
+        del result['c'], value['c']
+        self.assertEqual(value, result)
+        self.assertIsInstance(result['b'], bp.UID)
+    
+    def test_convert(self):
+        value = {'a': [1, 2.5, 'x', bp.UID(3), {'b': u'\xf6'}],
+                 'c': datetime(2010, 6, 1, 12, tzinfo=bp.UTC)}
+        xml = StringIO()
+        bp.convert(StringIO(bp.dumps(value, binary=True)), xml)
+        self.assertEqual(bp.loads(xml.getvalue(), dates='utc'), value)
+        binary = StringIO()
+        bp.convert(StringIO(xml.getvalue()), binary)
+        self.assertEqual(binary.getvalue()[:8], 'bplist00')
+        self.assertEqual(bp.loads(binary.getvalue(), dates='utc'), value)
+    
+    def test_validate(self):
+        value = {'a': [1, 2, 'x'], 'b': {'c': None}}
+        stats = bp.validate(bp.dumps(value, binary=True))
+        self.assertEqual(stats['objects'], 10)
+        self.assertEqual(stats['types']['dict'], 2)
+        self.assertEqual(stats['max_depth'], 2)
+        self.assertEqual(stats['reachable'], 10)
+        fn = 'tmp'
+        bp.writePlist(value, fn, binary=True)
+        with open(fn, 'rb') as fp:
+            self.assertEqual(bp.validate(fp), stats)
+        remove('tmp')
+    
+    def test_validate_invalid(self):
+        plist = bp.dumps(range(20), binary=True)
+        self.assertRaises(bp.InvalidPlistError, bp.validate, plist[:-40])
+        self.assertRaises(bp.InvalidPlistError, bp.validate,
+                          plist[:8] + '\xaf\x13\xff' + plist[11:])
+        cycle = 'bplist00\xa1\x00\x08' + pack('>6xBBQQQ', 1, 1, 1, 0, 10)
+        self.assertRaises(bp.InvalidPlistError, bp.validate, cycle)
+    
+    def test_limits(self):
+        value = {'a': [[['x' * 1000]]], 'b': range(50)}
+        plist = bp.dumps(value, binary=True)
+        self.assertEqual(bp.loads(plist, limits={'max_objects': 100}), value)
+        for limits in ({'max_objects': 20}, {'max_bytes': 500},
+                       {'max_depth': 3}, {'max_object_size': 999},
+                       {'timeout': -1}):
+            self.assertRaises(bp.LimitExceededError, bp.loads, plist,
+                              limits=limits)
+    
+    def test_limits_declared_length(self):
+        plist = bp.dumps(['x' * 300], binary=True)
+        index = plist.index('\x11\x01\x2c')
+        plist = plist[:index] + '\x11\xff\xff' + plist[index + 3:]
+        self.assertRaises(bp.LimitExceededError, bp.loads, plist, limits={})
+    
+    def test_limits_shared(self):
+        # each array refers twice to the one before it
+        objects = ['\x10\x01'] + [pack('>BBB', 0xa2, i, i) for i in range(20)]
+        offsets = [8]
+        for object_ in objects[:-1]:
+            offsets.append(offsets[-1] + len(object_))
+        table_offset = offsets[-1] + len(objects[-1])
+        plist = ('bplist00' + ''.join(objects) +
+                 ''.join(chr(offset) for offset in offsets) +
+                 pack('>6xBBQQQ', 1, 1, 21, 20, table_offset))
+        self.assertRaises(bp.LimitExceededError, bp.loads, plist,
+                          limits={'max_objects': 1000})
+        self.assertRaises(bp.LimitExceededError, bp.loads, plist,
+                          limits={'max_bytes': 10000})
+        cycle = 'bplist00\xa1\x00\x08' + pack('>6xBBQQQ', 1, 1, 1, 0, 10)
+        self.assertRaises(bp.LimitExceededError, bp.loads, cycle, limits={})
+    
+    def test_limits_xml(self):
+        plist = bp.dumps({'a': [range(50)], 'b': 'x' * 300})
+        self.assertEqual(bp.loads(plist, limits={'max_objects': 100}),
+                         {'a': [range(50)], 'b': 'x' * 300})
+        for limits in ({'max_objects': 10}, {'max_depth': 2},
+                       {'max_object_size': 100}, {'max_bytes': 100}):
+            self.assertRaises(bp.LimitExceededError, bp.loads, plist,
+                              limits=limits)
+        entities = ('<?xml version="1.0"?><!DOCTYPE plist [<!ENTITY a "' +
+                    'x' * 100 + '"><!ENTITY b "' + '&a;' * 100 + '">]>' +
+                    '<plist><string>&b;&b;</string></plist>')
+        self.assertRaises(ValueError, bp.loads, entities)
+        self.assertRaises(ValueError, bp.loads, entities,
+                          limits={'max_bytes': 10000})
+    
+    def test_limits_compressed(self):
+        plist = bp.dumps(['x' * 1000000], binary=True)
+        for compression in ('gzip', 'bz2'):
+            compressed = bp.dumps(['x' * 1000000], binary=True,
+                                  compression=compression)
+            self.assertEqual(bp.loads(compressed, limits={}),
+                             ['x' * 1000000])
+            self.assertRaises(bp.LimitExceededError, bp.loads, compressed,
+                              limits={'max_bytes': len(plist) - 1})
+    
+    def test_diff(self):
+        old = {'a': [1, 2, 3], 'b': {'c': 'x', 'd': range(10)}, 'e': 5}
+        new = {'a': [1, 7], 'b': {'c': 'x', 'd': range(10)}, 'f': True}
+        changes = bp.diff(StringIO(bp.dumps(old, binary=True)),
+                          StringIO(bp.dumps(new, binary=True,
+                                            layout='breadth-first')))
+        self.assertEqual(sorted(changes),
+                         [('added', ('f',), None, True),
+                          ('changed', ('a', 1), 2, 7),
+                          ('removed', ('a', 2), 3, None),
+                          ('removed', ('e',), 5, None)])
+    
+    def test_diff_identical(self):
+        value = {'a': [1, {'b': 'c'}]}
+        changes = bp.diff(StringIO(bp.dumps(value, binary=True)),
+                          StringIO(bp.dumps(value, binary=True,
+                                            layout='depth-first')))
+        self.assertEqual(list(changes), [])
+    
+    def test_diff_decodes(self):
+        old = dict(('key%i' % i, 'value %i' % i) for i in range(1000))
+        new = dict(old, key5='changed')
+        plists = [StringIO(bp.dumps(value, binary=True))
+                  for value in (old, new)]
+        decode_body = bplistlib.classes.StringHandler.decode_body
+        decoded = []
+        def counting_decode_body(handler, raw, object_length):
+            decoded.append(raw)
+            return decode_body(handler, raw, object_length)
+        bplistlib.classes.StringHandler.decode_body = counting_decode_body
+        try:
+            changes = list(bp.diff(*plists))
+        finally:
+            bplistlib.classes.StringHandler.decode_body = decode_body
+        self.assertEqual(changes,
+                         [('changed', ('key5',), 'value 5', 'changed')])
+        # the key, and the old and new values, but none of the others
+        self.assertTrue(len(decoded) < 10)
+    
+    def test_diff_deep(self):
+        changes = list(bp.diff(StringIO(deep_plist(1)),
+                               StringIO(deep_plist(2))))
+        self.assertEqual(changes, [('changed', (0,) * 2000, 1, 2)])
+        reader = bplistlib.readwrite.ObjectReader(StringIO(deep_plist(1)))
+        object_ = reader.read_object(reader.root)
+        for i in range(2000):
+            object_ = object_[0]
+        self.assertEqual(object_, 1)
+        cycle = 'bplist00\xa1\x00\x08' + pack('>6xBBQQQ', 1, 1, 1, 0, 10)
+        reader = bplistlib.readwrite.ObjectReader(StringIO(cycle))
+        self.assertRaises(ValueError, reader.read_object, 0)
+        self.assertRaises(ValueError, list,
+                          bp.diff(StringIO(cycle), StringIO(deep_plist(1))))
+    
+    def test_convert_deep(self):
+        output = StringIO()
+        bp.convert(StringIO(deep_plist(1)), output)
+        object_ = bp.loads(output.getvalue())
+        for i in range(2000):
+            object_ = object_[0]
+        self.assertEqual(object_, 1)
+        cycle = 'bplist00\xa1\x00\x08' + pack('>6xBBQQQ', 1, 1, 1, 0, 10)
+        self.assertRaises(ValueError, bp.convert, StringIO(cycle), StringIO())
+    
+    def test_merge(self):
+        values = [{'a': [1, 2], 'b': 'x'}, [u'w\xf6rld', 'x', 2.5], 'x']
+        plists = [StringIO(bp.dumps(value, binary=True)) for value in values]
+        fp = StringIO()
+        bp.merge(plists, fp)
+        self.assertEqual(bp.loads(fp.getvalue()), values)
+        fp = StringIO()
+        bp.merge(plists, fp, into='dict', keys=['p', 'q', 'r'], dedupe=True)
+        self.assertEqual(bp.loads(fp.getvalue()),
+                         dict(zip(['p', 'q', 'r'], values)))
+        self.assertEqual(bp.validate(fp.getvalue())['types']['string'], 6)
+        self.assertRaises(ValueError, bp.merge, plists, StringIO(), 'dict')
+    
+    def test_merge_many_objects(self):
+        values = [range(i, i + 200) for i in range(0, 400, 100)]
+        plists = [StringIO(bp.dumps(value, binary=True)) for value in values]
+        fp = StringIO()
+        self.assertEqual(bp.merge(plists, fp), 805)
+        self.assertEqual(bp.loads(fp.getvalue()), values)
+        fp = StringIO()
+        self.assertEqual(bp.merge(plists, fp, dedupe=True), 505)
+        self.assertEqual(bp.loads(fp.getvalue()), values)
+    
+    def test_estimate(self):
+        value = {'a': [1, 2 ** 40, -3, 2.5, datetime(2010, 6, 1)],
+                 'b': 'x' * 20, u'c\xf6': u'w\xf6rld' * 10, 'd': bp.UID(300),
+                 'e': Data('\x00' * 300), 'f': [None, True, bp.Fill],
+                 'g': range(20)}
+        plan = bp.estimate(value)
+        plist = bp.dumps(value, binary=True, plan=plan)
+        self.assertEqual(plan.size, len(plist))
+        self.assertEqual(plan.object_count, bp.validate(plist)['objects'])
+        self.assertEqual(plan.offset_size, 2)
+        self.assertEqual(plan.reference_size, 1)
+        self.assertTrue(plan.fits)
+        self.assertEqual(bp.loads(plist), value)
+        self.assertEqual(bp.dumps(value, binary=True), plist)
+        self.assertRaises(ValueError, bp.dumps, {}, True, plan=plan)
+        self.assertRaises(ValueError, bp.dumps, value, plan=plan)
+    
+    def test_estimate_many_objects(self):
+        value = [str(i) for i in range(300)]
+        plan = bp.estimate(value, layout='depth-first')
+        self.assertEqual(plan.reference_size, 2)
+        self.assertEqual(plan.size, len(bp.dumps(value, True, plan=plan)))
+    
+    def test_command_line(self):
+        fn = 'tmp'
+        bp.writePlist({'a': [1, {'b': 'c'}], '12': 'x'}, fn, binary=True)
+        output = StringIO()
+        self.assertEqual(bplistlib.__main__.main(['info', fn], output), 0)
+        self.assertIn('objects: 9\n', output.getvalue())
+        output = StringIO()
+        self.assertEqual(bplistlib.__main__.main(['stats', fn], output), 0)
+        self.assertIn('total               9', output.getvalue())
+        for keys, value in ((['a', '1', 'b'], 'c\n'), (['12'], 'x\n')):
+            output = StringIO()
+            bplistlib.__main__.main(['get', fn] + keys, output)
+            self.assertEqual(output.getvalue(), value)
+        bplistlib.__main__.main(['convert', fn, 'tmp.xml'])
+        self.assertEqual(bp.readPlist('tmp.xml', binary=False),
+                         bp.readPlist(fn))
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertEqual(bplistlib.__main__.main(['get', fn, 'b']), 1)
+            self.assertEqual(bplistlib.__main__.main(['get', 'tmp.xml', 'b']),
+                             1)
+            self.assertEqual(sys.stderr.getvalue(),
+                             'no such key: b\nno such key: b\n')
+            plist = open(fn, 'rb').read()
+            with open(fn, 'wb') as file_object:
+                # make the first object an unknown type
+                file_object.write(plist[:8] + '\x70' + plist[9:])
+            sys.stderr = StringIO()
+            self.assertEqual(bplistlib.__main__.main(['get', fn]), 1)
+            self.assertTrue(sys.stderr.getvalue().startswith('invalid plist'))
+            with open(fn, 'wb') as file_object:
+                file_object.write('bplist00\xa1\x00\x08' +
+                                  pack('>6xBBQQQ', 1, 1, 1, 0, 10))
+            sys.stderr = StringIO()
+            self.assertEqual(bplistlib.__main__.main(['get', fn]), 1)
+            self.assertEqual(bplistlib.__main__.main(['convert', fn,
+                                                      'tmp.xml']), 1)
+            self.assertEqual(sys.stderr.getvalue(),
+                             'invalid plist: reference cycle at object 0\n' * 2)
+        finally:
+            sys.stderr = stderr
+        with open(fn, 'wb') as file_object:
+            file_object.write(deep_plist(1))
+        self.assertEqual(bplistlib.__main__.main(['convert', fn, 'tmp.xml']),
+                         0)
+        object_ = bp.readPlist('tmp.xml')
+        for i in range(2000):
+            object_ = object_[0]
+        self.assertEqual(object_, 1)
+        remove('tmp')
+        remove('tmp.xml')
+    
+    def test_subclasses(self):
+        value = OrderedDict([('a', (1, 2)), ('b', Number(3))])
+        for binary in (True, False):
+            result = through_string(value, write_binary=binary)
+            self.assertEqual(result, {'a': [1, 2], 'b': 3})
+        result = bp.loads(bp.dumps(value, stream=True))
+        self.assertEqual(result, {'a': [1, 2], 'b': 3})
+    
+    def test_default(self):
+        value = {'a': Point(1, 2), 'b': [Point(1, 2), Point(3, 4)]}
+        default = lambda point: {'x': point.x, 'y': point.y}
+        object_hook = lambda d: Point(d['x'], d['y']) if 'x' in d else d
+        for binary in (True, False):
+            plist = bp.dumps(value, binary, default=default)
+            result = bp.loads(plist, object_hook=object_hook)
+            self.assertEqual(result, value)
+        plist = bp.dumps(value, stream=True, default=default)
+        result = bp.loads(plist, object_hook=object_hook,
+                          array_hook=tuple)
+        self.assertEqual(result['b'], (Point(1, 2), Point(3, 4)))
+        self.assertRaises(TypeError, bp.dumps, value, True)
+    
+    def test_default_stream(self):
+        default = lambda point: [point.x, point.y]
+        fp = StringIO()
+        stream_writer = bplistlib.readwrite.StreamWriter(fp, default=default)
+        stream_writer.add(Point(i, i) for i in range(1000))
+        stream_writer.close()
+        self.assertEqual(bp.loads(fp.getvalue()), [[i, i] for i in range(1000)])
+        # the converted points aren't kept
+        self.assertEqual(stream_writer.object_handler.converted, {})
+    
+    def test_compression(self):
+        value = {'1': range(50), '3': 'four' * 100}
+        for compression in ('gzip', 'bz2', 'block'):
+            for binary in (True, False):
+                plist = bp.dumps(value, binary, compression)
+                self.assertNotEqual(plist[:8], 'bplist00')
+                result = bp.loads(plist)
+                self.assertEqual(value, result)
+    
+    def test_compression_names(self):
+        value = {'1': range(50)}
+        for compression in ('lzma', 'xz'):
+            if bplistlib.compression.lzma is None:
+                self.assertRaises(ValueError, bp.dumps, value, True,
+                                  compression)
+            else:
+                plist = bp.dumps(value, True, compression)
+                self.assertEqual(bp.loads(plist), value)
+        for compression in ('zlib', 'zip'):
+            self.assertRaises(ValueError, bp.dumps, value, True, compression)
+            self.assertRaises(ValueError, bp.loads, 'x', True, compression)
+    
+    def test_block_compression_file(self):
+        value = [str(i) * 1000 for i in range(300)]
+        fn = 'tmp'
+        bp.writePlist(value, fn, binary=True, compression='block')
+        result = bp.readPlist(fn)
+        self.assertEqual(value, result)
+        remove('tmp')
+    
+    def test_stream(self):
+        rows = ({'id': i, 'name': 'row %i' % i} for i in range(300))
+        value = {'rows': rows, 'nested': [iter([1, [2, 3]]), u'x']}
+        plist = bp.dumps(value, stream=True)
+        result = bp.loads(plist)
+        expected = [{'id': i, 'name': 'row %i' % i} for i in range(300)]
+        self.assertEqual(result['rows'], expected)
+        self.assertEqual(result['nested'], [[1, [2, 3]], u'x'])
+    
+    def test_stream_many_objects(self):
+        value = xrange(70000)
+        plist = bp.dumps(value, stream=True, compression='block')
+        result = bp.loads(plist)
+        self.assertEqual(range(70000), result)
+    
+    def test_layout(self):
+        value = {'a': [1, {'b': 'c'}], 'd': {'e': [2, 3]}, 'f': 4}
+        for layout in ('breadth-first', 'depth-first', 'hot-keys'):
+            plist = bp.dumps(value, binary=True, layout=layout,
+                             hot_keys=['f', 'e'])
+            result = bp.loads(plist)
+            self.assertEqual(value, result)
+    
+    def test_hot_keys_layout(self):
+        value = {'cold': 'x' * 20, 'hot': 'y' * 20}
+        plist = bp.dumps(value, binary=True, layout='hot-keys',
+                         hot_keys=['hot'])
+        self.assertLess(plist.index('hot'), plist.index('cold'))
+        self.assertLess(plist.index('y' * 20), plist.index('x' * 20))
+    
+    def test_cache(self):
+        fn = 'tmp'
+        bp.writePlist({'a': [1, 2]}, fn, binary=True)
+        cache = bp.PlistCache()
+        first = bp.readPlist(fn, cache=cache)
+        first['a'].append(3)
+        second = bp.readPlist(fn, cache=cache)
+        self.assertEqual(second, {'a': [1, 2]})
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        bp.writePlist({'b': 1}, fn, binary=True)
+        utime(fn, (0, 0))
+        self.assertEqual(bp.readPlist(fn, cache=cache), {'b': 1})
+        self.assertEqual(cache.stats()['entries'], 1)
+        cache.invalidate(fn)
+        self.assertEqual(cache.stats()['entries'], 0)
+        remove('tmp')
+    
+    def test_frozen_cache(self):
+        fn = 'tmp'
+        bp.writePlist({'a': [1, 2]}, fn, binary=True)
+        cache = bp.PlistCache(frozen=True)
+        result = bp.readPlist(fn, cache=cache)
+        self.assertIs(result, bp.readPlist(fn, cache=cache))
+        self.assertEqual(result, {'a': [1, 2]})
+        self.assertRaises(TypeError, result.update, {'b': 3})
+        self.assertRaises(TypeError, result['a'].append, 3)
+        self.assertRaises(TypeError, result['a'].__setitem__, 0, 3)
+        bp.writePlist({'a': Data('x')}, fn, binary=True)
+        result = bp.readPlist(fn, cache=cache)
+        self.assertEqual(result, {'a': Data('x')})
+        self.assertRaises(TypeError, setattr, result['a'], 'data', 'y')
+        remove('tmp')
+    
+    def test_cache_options(self):
+        fn = 'tmp'
+        bp.writePlist({'a': datetime(2010, 6, 1)}, fn, binary=True)
+        cache = bp.PlistCache()
+        for dates in ('utc', 'datetime', 'utc', 'datetime'):
+            bp.readPlist(fn, dates=dates, cache=cache)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['entries'], 2)
+        remove('tmp')
+    
+    def test_cache_size(self):
+        fn = 'tmp'
+        bp.writePlist(['x' * 1000000], fn, binary=True, compression='gzip')
+        cache = bp.PlistCache(max_bytes=100000)
+        self.assertEqual(bp.readPlist(fn, cache=cache), ['x' * 1000000])
+        # the file is small, but what it decodes to doesn't fit
+        self.assertEqual(cache.stats()['entries'], 0)
+        cache = bp.PlistCache()
+        bp.readPlist(fn, cache=cache)
+        self.assertTrue(cache.stats()['size'] > 1000000)
+        remove('tmp')
+    
+    def test_parallel_read(self):
+        value = {'a': range(300), 'b': [bp.UID(3), bp.Fill, None, 'x']}
+        fn = 'tmp'
+        bp.writePlist(value, fn, binary=True)
+        threshold = bplistlib.readwrite.PARALLEL_THRESHOLD
+        bplistlib.readwrite.PARALLEL_THRESHOLD = 0
+        try:
+            result = bp.readPlist(fn, processes=2)
+        finally:
+            bplistlib.readwrite.PARALLEL_THRESHOLD = threshold
+        self.assertEqual(value, result)
+        self.assertIs(result['b'][1], bp.Fill)
+        remove('tmp')
+    
+    def test_query(self):
+        value = {'a': {'b': [1, 'two', {'c': u'three'}]}, 'd': 4}
+        fn = 'tmp'
+        bp.writePlist(value, fn, binary=True)
+        self.assertEqual(bp.query(fn, ('a', 'b', 2, 'c')), u'three')
+        self.assertEqual(bp.build_index(fn), 8)
+        self.assertEqual(bp.query(fn, ('a', 'b', 1)), 'two')
+        self.assertEqual(bp.query(fn, ()), value)
+        self.assertRaises(KeyError, bp.query, fn, ('a', 'x'))
+        remove('tmp')
+        remove('tmp.index')
+    
+    def test_stale_index(self):
+        fn = 'tmp'
+        bp.writePlist({'a': 1}, fn, binary=True)
+        bp.build_index(fn)
+        bp.writePlist({'a': [2]}, fn, binary=True)
+        utime(fn, (0, 0))
+        self.assertEqual(bp.query(fn, ('a', 0)), 2)
+        remove('tmp')
+        remove('tmp.index')
+    
+    def test_index_offsets(self):
+        fn = 'tmp'
+        bp.writePlist({'a': [1, 2], 'b': 'c'}, fn, binary=True)
+        utime(fn, (1000000, 1000000))
+        bp.build_index(fn)
+        plist = open(fn, 'rb').read()
+        reader = bplistlib.readwrite.ObjectReader(StringIO(plist), lazy=True)
+        self.assertEqual(list(reader.offsets),
+                         list(bplistlib.readwrite.ObjectReader(
+                             StringIO(plist)).offsets))
+        # the offset of 'c' comes from the index, not the offset table
+        position = reader.trailer[4] + reader.find(('b',))
+        with open(fn, 'wb') as file_object:
+            file_object.write(plist[:position] + '\xff' +
+                              plist[position + 1:])
+        utime(fn, (1000000, 1000000))
+        self.assertEqual(bp.query(fn, ('b',)), 'c')
+        self.assertEqual(bp.query(fn, ('a', 1)), 2)
+        remove('tmp')
+        remove('tmp.index')
+    
+    def test_index_cycle(self):
+        fn = 'tmp'
+        with open(fn, 'wb') as file_object:
+            file_object.write('bplist00\xa1\x00\x08' +
+                              pack('>6xBBQQQ', 1, 1, 1, 0, 10))
+        self.assertRaises(ValueError, bp.build_index, fn)
+        remove('tmp')
+    
+
+class Number(int):
+    pass
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+    
+    def __eq__(self, other):
+        return (self.x, self.y) == (other.x, other.y)
+
 
 def through_string(value, write_binary=True, read_binary=None):
     plist = bp.dumps(value, binary=write_binary)
     return bp.loads(plist, binary=read_binary)
 
 
+def deep_plist(value):
+    # 2000 arrays, each holding the one before, around an integer
+    objects = [pack('>BB', 0x10, value)]
+    objects += [pack('>BH', 0xa1, i) for i in range(2000)]
+    offsets = [8]
+    for object_ in objects[:-1]:
+        offsets.append(offsets[-1] + len(object_))
+    table_offset = offsets[-1] + len(objects[-1])
+    return ('bplist00' + ''.join(objects) +
+            ''.join(pack('>H', offset) for offset in offsets) +
+            pack('>6xBBQQQ', 2, 2, 2001, 2000, table_offset))
+
+
 
 def suite():
     suite = unittest.TestSuite()